@@ -44,7 +44,8 @@ setup(
         },
     
     install_requires = [ 
-        'nesoni' 
+        'nesoni',
+        'numpy',
         ],
     
     classifiers = [
@@ -4,20 +4,39 @@ Test for shift of expression from one tail to another within a gene.
 
 """
 
-import json, collections
+import os, json, types, collections
+
+import numpy
 
 import nesoni
 from nesoni import config, io, bio, annotation, runr, reference_directory
+from . import columnar, faidx
 
-def _float_or_none(text):
-    if text == 'NA':
-        return None
-    return float(text)
+def _value_matrix(type, values):
+    """ Numeric matrix from a columnar group as rows of Python values, None where missing. 
+        (The csv module writes None as an empty field, and floats with repr.) """
+    if type == 'int32':
+        return [ [ None if item == columnar.NA_INTEGER else item for item in row ] for row in values.tolist() ]
+    return [ [ None if item != item else item for item in row ] for row in values.tolist() ]
 
-def _text(value):
-    if value is None:
-        return 'NA'
-    return str(value)
+def _write_json(f, value):
+    """ Write value as JSON without holding all of the text in memory.
+        OrderedDicts are written item by item, and generators are written as arrays. """
+    if isinstance(value, collections.OrderedDict):
+        f.write('{')
+        for i, (key, item) in enumerate(value.iteritems()):
+            if i: f.write(', ')
+            f.write(json.dumps(key) + ': ')
+            _write_json(f, item)
+        f.write('}')
+    elif isinstance(value, types.GeneratorType):
+        f.write('[')
+        for i, item in enumerate(value):
+            if i: f.write(', ')
+            _write_json(f, item)
+        f.write(']')
+    else:
+        f.write(json.dumps(value))
 
 def _annotation_sorter(item):
     if item.strand < 0:
@@ -117,6 +136,10 @@ sink()
 @config.Int_flag('max_seq',
     'Maximum length of pre-peak and inter-peak sequence to include in output.'
     )
+@config.Bool_flag('json_chunks',
+    'Split the gene viewer data by chromosome into files in <prefix>-json/, '
+    'which the viewer loads on demand. <prefix>.json is then only an index.'
+    )
 @config.Positional('reference', 'Reference sequences.')
 @config.Positional('parents', 'Annotation file containing parent genes.')
 @config.Positional('children', 'Annotation file containing child peaks. "Parent" property should be set.')
@@ -128,6 +151,7 @@ class Compare_peaks(config.Action_with_prefix):
     utr_only = True
     top = 0
     max_seq = 50000
+    json_chunks = False
     reference = None
     parents = None
     children = None
@@ -138,8 +162,8 @@ class Compare_peaks(config.Action_with_prefix):
         
         # Reference genome
         
-        #chromosome_lengths = reference_directory.Reference(self.reference, must_exist=True).get_lengths()
-        chromosomes = collections.OrderedDict(io.read_sequences(self.reference))
+        # Lengths come from the index, sequence is only read if needed
+        chromosomes = faidx.Indexed_fasta(self.reference)
 
         def get_interpeak_seq(peaks):
             start = min(item.transcription_stop for item in peaks)
@@ -195,28 +219,22 @@ class Compare_peaks(config.Action_with_prefix):
             utrs = [ ]
         children = list(annotation.read_annotations(self.children))
         
-        count_table = io.read_grouped_table(self.counts, [
-            ('Count',int),
-            ('Tail_count',int),
-            ('Tail',_float_or_none),
-            ('Proportion',_float_or_none),
-            ('Annotation',str)
-            ])
-        counts = count_table['Count']
-        tail_counts = count_table['Tail_count']
-        proportions = count_table['Proportion']
-        tails = count_table['Tail']
+        table = columnar.read(self.counts)
+        
+        def row(group, item):
+            return table[group].row(table.feature_index[item.get_id()])
         
-        samples = counts.value_type().keys()
+        samples = table['Count'].columns
         sample_tags = { }
-        for line in count_table.comments:
+        for line in table.comments:
             if line.startswith('#sampleTags='):
                 parts = line[len('#sampleTags='):].split(',')
                 assert parts[0] not in sample_tags
                 sample_tags[parts[0]] = parts
         
+        multipliers = [ float(norms[name]['Normalizing.multiplier']) for name in samples ]
         for item in children:
-            item.weight = sum( counts[item.get_id()][name] * float(norms[name]['Normalizing.multiplier']) for name in samples )
+            item.weight = sum( count * multiplier for count, multiplier in zip(row('Count',item), multipliers) )
         
         parents = [ ]
         id_to_parent = { }
@@ -288,80 +306,110 @@ class Compare_peaks(config.Action_with_prefix):
         
         
         
-        # JSON output
+        # JSON output, for the gene viewer
         
-        j_data = { }
-        j_genes = j_data['genes'] = { }
+        def gene_columns(genes):
+            return collections.OrderedDict([
+                ('__comment__', 'start is 0-based'),
+                ('name', ( item.get_id() for item in genes )),
+                ('chromosome', ( item.seqid for item in genes )),
+                ('strand', ( item.strand for item in genes )),
+                ('start', ( item.start for item in genes )),
+                ('utr', ( item.utr_pos for item in genes )),
+                ('end', ( item.end for item in genes )),
+                ('gene', ( item.attr.get('Name',item.attr.get('gene','')) for item in genes )),
+                ('product', ( item.attr.get('Product',item.attr.get('product','')) for item in genes )),
+                ('peaks', ( [ item2.get_id() for item2 in item.children ] for item in genes )),
+                ('relevant_peaks', ( [ item2.get_id() for item2 in item.relevant_children ] for item in genes )),
+                ])
         
-        j_genes['__comment__'] = 'start is 0-based'
-        j_genes['name'] = [ ]
-        j_genes['chromosome'] = [ ]
-        j_genes['strand'] = [ ]
-        j_genes['start'] = [ ]
-        j_genes['utr'] = [ ]
-        j_genes['end'] = [ ]
-        j_genes['gene'] = [ ]
-        j_genes['product'] = [ ]
-        j_genes['peaks'] = [ ]
-        j_genes['relevant_peaks'] = [ ]
-        #j_genes['cds'] = [ ]
-        #j_genes['cds_start'] = [ ]
-        #j_genes['cds_end'] = [ ]
-        for item in parents:
-            j_genes['name'].append( item.get_id() )
-            j_genes['chromosome'].append( item.seqid )
-            j_genes['strand'].append( item.strand )
-            j_genes['start'].append( item.start )
-            j_genes['utr'].append( item.utr_pos )
-            j_genes['end'].append( item.end )
-            j_genes['gene'].append( item.attr.get('Name',item.attr.get('gene','')) )
-            j_genes['product'].append( item.attr.get('Product',item.attr.get('product','')) )
-            j_genes['peaks'].append( [ item2.get_id() for item2 in item.children ] )
-            j_genes['relevant_peaks'].append( [ item2.get_id() for item2 in item.relevant_children ] )
-            #j_genes['cds'].append( item.cds )
-            #j_genes['cds_start'].append( item.cds_start )
-            #j_genes['cds_end'].append( item.cds_end )
-        
-        j_peaks = j_data['peaks'] = { }
-        j_peaks['__comment__'] = 'start is 0-based'
-        j_peaks['name'] = [ ]
-        j_peaks['chromosome'] = [ ]
-        j_peaks['strand'] = [ ]
-        j_peaks['start'] = [ ]
-        j_peaks['end'] = [ ]
-        j_peaks['parents'] = [ ]
-        j_peaks['counts'] = [ ]
-        j_peaks['tail_lengths'] = [ ]
-        j_peaks['proportion_tailed'] = [ ]
-        for item in children:
-            j_peaks['name'].append( item.get_id() )
-            j_peaks['chromosome'].append( item.seqid )
-            j_peaks['strand'].append( item.strand )
-            j_peaks['start'].append( item.start )
-            j_peaks['end'].append( item.end )
-            j_peaks['parents'].append( item.attr['Parent'].split(',') if 'Parent' in item.attr else [ ])
-            j_peaks['counts'].append( counts[item.get_id()].values() )
-            j_peaks['tail_lengths'].append( count_table['Tail'][item.get_id()].values() )
-            j_peaks['proportion_tailed'].append( count_table['Proportion'][item.get_id()].values() )
-        
-        j_samples = j_data['samples'] = { }
-        j_samples['name'] = [ ]
-        j_samples['tags'] = [ ]
-        j_samples['normalizing_multiplier'] = [ ]
-        for name in samples:
-            j_samples['name'].append(name)
-            j_samples['tags'].append(sample_tags[name])
-            j_samples['normalizing_multiplier'].append(float(norms[name]['Normalizing.multiplier']))
-        
-        j_chromosomes = j_data['chromosomes'] = { }
-        j_chromosomes['name'] = [ ]
-        j_chromosomes['length'] = [ ]
-        for name, seq in chromosomes.iteritems():
-            j_chromosomes['name'].append(name)
-            j_chromosomes['length'].append(len(seq))        
-        
-        with open(self.prefix + '.json','wb') as f:
-            json.dump(j_data, f)
+        def peak_columns(peaks):
+            return collections.OrderedDict([
+                ('__comment__', 'start is 0-based'),
+                ('name', ( item.get_id() for item in peaks )),
+                ('chromosome', ( item.seqid for item in peaks )),
+                ('strand', ( item.strand for item in peaks )),
+                ('start', ( item.start for item in peaks )),
+                ('end', ( item.end for item in peaks )),
+                ('parents', ( item.attr['Parent'].split(',') if 'Parent' in item.attr else [ ] for item in peaks )),
+                ('counts', ( row('Count',item) for item in peaks )),
+                ('tail_lengths', ( row('Tail',item) for item in peaks )),
+                ('proportion_tailed', ( row('Proportion',item) for item in peaks )),
+                ])
+        
+        j_samples = collections.OrderedDict([
+            ('name', samples),
+            ('tags', [ sample_tags[name] for name in samples ]),
+            ('normalizing_multiplier', multipliers),
+            ])
+        
+        chromosome_lengths = chromosomes.lengths()
+        j_chromosomes = collections.OrderedDict([
+            ('name', [ name for name, length in chromosome_lengths ]),
+            ('length', [ length for name, length in chromosome_lengths ]),
+            ])
+        
+        if not self.json_chunks:
+            with open(self.prefix + '.json','wb') as f:
+                _write_json(f, collections.OrderedDict([
+                    ('genes', gene_columns(parents)),
+                    ('peaks', peak_columns(children)),
+                    ('samples', j_samples),
+                    ('chromosomes', j_chromosomes),
+                    ]))
+        
+        else:
+            # One chunk per chromosome, loaded on demand by the gene viewer. 
+            # The main file is an index sufficient to search for genes and peaks.
+            chunk_dir = self.prefix + '-json'
+            if not os.path.exists(chunk_dir):
+                os.mkdir(chunk_dir)
+            
+            grouped = collections.OrderedDict( (name, ([ ],[ ])) for name, length in chromosome_lengths )
+            for item in parents:
+                grouped.setdefault(item.seqid, ([ ],[ ]))[0].append(item)
+            for item in children:
+                grouped.setdefault(item.seqid, ([ ],[ ]))[1].append(item)
+            
+            chunk_filenames = [ ]
+            index_genes = [ ]
+            index_gene_chunks = [ ]
+            index_peaks = [ ]
+            index_peak_chunks = [ ]
+            for genes, peaks in grouped.values():
+                if not genes and not peaks: continue
+                i = len(chunk_filenames)
+                chunk_filenames.append( os.path.basename(chunk_dir) + '/%d.json' % i )
+                with open(os.path.join(chunk_dir, '%d.json' % i),'wb') as f:
+                    _write_json(f, collections.OrderedDict([
+                        ('genes', gene_columns(genes)),
+                        ('peaks', peak_columns(peaks)),
+                        ]))
+                index_genes.extend(genes)
+                index_gene_chunks.extend([ i ] * len(genes))
+                index_peaks.extend(peaks)
+                index_peak_chunks.extend([ i ] * len(peaks))
+            
+            tails = table['Tail'].values[[ table.feature_index[item.get_id()] for item in children ]]
+            tails = tails[~numpy.isnan(tails)]
+            
+            with open(self.prefix + '.json','wb') as f:
+                _write_json(f, collections.OrderedDict([
+                    ('chunks', chunk_filenames),
+                    ('max_tail', max(1.0, float(tails.max())) if len(tails) else 1.0),
+                    ('genes', collections.OrderedDict([
+                        ('name', ( item.get_id() for item in index_genes )),
+                        ('gene', ( item.attr.get('Name',item.attr.get('gene','')) for item in index_genes )),
+                        ('peaks', ( [ item2.get_id() for item2 in item.children ] for item in index_genes )),
+                        ('chunk', index_gene_chunks),
+                        ])),
+                    ('peaks', collections.OrderedDict([
+                        ('name', ( item.get_id() for item in index_peaks )),
+                        ('chunk', index_peak_chunks),
+                        ])),
+                    ('samples', j_samples),
+                    ('chromosomes', j_chromosomes),
+                    ]))
         
         
         # Output paired peak file
@@ -375,69 +423,67 @@ class Compare_peaks(config.Action_with_prefix):
             output_samples.append(item+'-peak2')
             output_comments.append('#sampleTags=' + ','.join([item+'-peak2','peak2']+sample_tags.get(item,[])))
         
-        output_names = [ ]
-        output_counts = [ ]
-        output_tail_counts = [ ]
-        output_proportions = [ ]
-        output_tails = [ ]
+        # Pairs of peaks as indices into the counts table, in the same order as nested loops over i < j
+        pair_parents = [ ]
+        pair_peaks = [ ]
+        pair_first = [ ]
+        pair_second = [ ]
+        for item in parents:
+            peaks = item.relevant_children
+            index = numpy.array([ table.feature_index[peak.get_id()] for peak in peaks ], 'int64')
+            first, second = numpy.triu_indices(len(peaks), 1)
+            pair_parents.extend([ item ] * len(first))
+            pair_peaks.extend( (peaks[i],peaks[j]) for i, j in zip(first.tolist(), second.tolist()) )
+            pair_first.append(index[first])
+            pair_second.append(index[second])
+        pair_first = numpy.concatenate(pair_first or [ numpy.zeros(0,'int64') ])
+        pair_second = numpy.concatenate(pair_second or [ numpy.zeros(0,'int64') ])
+        
+        features = table.features
+        output_names = [ 
+            item.get_id()+'-'+features[i]+'-'+features[j] 
+            for item, i, j in zip(pair_parents, pair_first.tolist(), pair_second.tolist()) ]
+        
+        # One gather per column group
+        output_groups = [ ]
+        for name in ['Count', 'Tail_count', 'Proportion', 'Tail']:
+            group = table[name]
+            assert group.type != 'string', 'Expected numeric values in group '+name
+            output_groups.append((name, output_samples, group.type, 
+                numpy.hstack([ group.values[pair_first], group.values[pair_second] ])))
+        
         output_annotation_fields = [ 'gene', 'product', 'biotype', 'mean_tail_1', 'mean_tail_2', 'chromosome', 'strand', 
                                      'transcription_stops' ] #, 'interpeak_seq', ]
+        mean_tail = table['Annotation'].values[ table['Annotation'].columns.index('mean-tail') ]
         output_annotations = [ ]
-            
-        for item in parents:
-            peaks = item.relevant_children
-            for i in xrange(len(peaks)-1):
-                for j in xrange(i+1, len(peaks)):
-                    id_i = peaks[i].get_id()
-                    id_j = peaks[j].get_id()
-                    id_pair = item.get_id() + '-'+id_i+'-'+id_j
-                    output_names.append(id_pair)
-                    
-                    row = [ ]
-                    row.extend(counts[id_i].values())
-                    row.extend(counts[id_j].values())
-                    output_counts.append(filter(_text,row))
-                    
-                    row = [ ]
-                    row.extend(tail_counts[id_i].values())
-                    row.extend(tail_counts[id_j].values())
-                    output_tail_counts.append(filter(_text,row))
-
-                    row = [ ]
-                    row.extend(proportions[id_i].values())
-                    row.extend(proportions[id_j].values())
-                    output_proportions.append(filter(_text,row))
-
-                    row = [ ]
-                    row.extend(tails[id_i].values())
-                    row.extend(tails[id_j].values())
-                    output_tails.append(filter(_text,row))
-                    
-                    output_annotations.append([
-                        item.attr.get('Name',item.attr.get('gene','')),
-                        item.attr.get('Product',item.attr.get('product','')),
-                        item.attr.get('Biotype',''),
-                        count_table['Annotation'][id_i]['mean-tail'],
-                        count_table['Annotation'][id_j]['mean-tail'],
-                        
-                        item.seqid,
-                        str(item.strand),
-                        '%d, %d' % (peaks[i].transcription_stop,peaks[j].transcription_stop),
-                        #get_interpeak_seq([peaks[i],peaks[j]]),
-                        ])
+        for item, (peak_i, peak_j), i, j in zip(pair_parents, pair_peaks, pair_first.tolist(), pair_second.tolist()):
+            output_annotations.append([
+                item.attr.get('Name',item.attr.get('gene','')),
+                item.attr.get('Product',item.attr.get('product','')),
+                item.attr.get('Biotype',''),
+                mean_tail[i],
+                mean_tail[j],
+                
+                item.seqid,
+                str(item.strand),
+                '%d, %d' % (peak_i.transcription_stop,peak_j.transcription_stop),
+                #get_interpeak_seq([peaks[i],peaks[j]]),
+                ])
         
-        #output_count_table = io.named_matrix_type(output_names,output_samples)(output_counts)
+        matrix = io.named_matrix_type(output_names,output_samples)
         io.write_grouped_csv(
             self.prefix + '-pairs.csv',
-            [ 
-                ('Count',io.named_matrix_type(output_names,output_samples)(output_counts)),
-                ('Tail_count',io.named_matrix_type(output_names,output_samples)(output_tail_counts)),
-                ('Proportion',io.named_matrix_type(output_names,output_samples)(output_proportions)),
-                ('Tail',io.named_matrix_type(output_names,output_samples)(output_tails)),
+            [ (name, matrix(_value_matrix(type, values))) for name, columns, type, values in output_groups ] + [
                 ('Annotation',io.named_matrix_type(output_names,output_annotation_fields)(output_annotations)),
                 ],
             comments=output_comments,
             )
+        
+        columnar.write_companion(
+            self.prefix + '-pairs.csv',
+            output_names,
+            output_groups + [ ('Annotation', output_annotation_fields, 'string', output_annotations) ],
+            output_comments)
                         
 #        # Chi Sq tests
 #        
@@ -2,38 +2,12 @@
 
 import heapq, subprocess, os, itertools, json, pickle
 
-import nesoni
-from nesoni import io, bio, grace, config, working_directory, sam
-
-from . import web
-
-def pile(spanners, initial=0):
-    n = len(spanners)
-    heap = [ (0,i,0) for i in xrange(n) ]
-    
-    pos = 0
-    value = initial
-    result = [ ]
-    while heap:
-        new_pos, i, j = heapq.heappop(heap)
-        
-        if new_pos != pos:
-            if result and result[-1][1] == value:
-                result[-1] = (result[-1][0]+new_pos-pos, value)
-            else:
-                result.append( (new_pos-pos, value) )
-        pos = new_pos
+import numpy
 
-        spanner = spanners[i]
-        if j:
-            value -= spanner[j-1][1]
-        if j < len(spanner):
-            item = spanner[j]
-            value += item[1]
-            heapq.heappush(heap, (pos+item[0], i,j+1))
-    
-    return result
+import nesoni
+from nesoni import io, bio, grace, config, working_directory, sam, workspace, legion
 
+from . import web, bigwig_writer
 
 def map_spanner(a_func, a_spanner):
     result = [ ]
@@ -47,68 +21,156 @@ def scale_spanner(scale, a_spanner):
     return map_spanner(lambda x: x*scale, a_spanner)
 
 
-def clip_spanner(length, spanner):
-    remaining = length
-    result = [ ]
-    for item_length, item_value in spanner:
-        if remaining <= 0: break
-        if item_length > remaining:
-            item_length = remaining
-        result.append((item_length, item_value))
-        remaining = remaining - item_length
-    return result
-
+class Coverage(object):
+    """ Depth of coverage of a sequence of a given length, accumulated from spanners.
+    
+        Spanners are converted to events (position, change in depth), which are
+        buffered then periodically sorted and summed into a sparse difference array
+        of breakpoints. Memory used depends on the number of distinct breakpoints 
+        rather than sequence length, and the depth is obtained by a cumulative sum.
+        """
+    buffer_size = 1<<20
 
-class Piler(object):
     def __init__(self, length):
         self.length = length
-        self.spanners = [[(length,0)]]
-    
-    def squash_from(self, i):
-        if i < len(self.spanners)-1:
-            #print "squash", i, len(self.spanners)
-            self.spanners[i:] = [ pile(self.spanners[i:]) ]
-            #print "done"
+        self.positions = numpy.zeros(0, 'int64')
+        self.deltas = numpy.zeros(0, 'int64')
+        self.buffer_positions = [ ]
+        self.buffer_deltas = [ ]
     
     def add(self, spanner):
         if not spanner: return
         
-        self.spanners.append(spanner)
+        pos = 0
+        for length, value in spanner:
+            if length and value:
+                self.buffer_positions.append(pos)
+                self.buffer_deltas.append(value)
+                self.buffer_positions.append(pos+length)
+                self.buffer_deltas.append(-value)
+            pos += length
         
-        #if len(self.spanners) < 1000000: return
+        if len(self.buffer_positions) >= self.buffer_size:
+            self.compact()
+    
+    def compact(self):
+        if not self.buffer_positions: return
         
-        i = len(self.spanners)-1
-        n = len(self.spanners[i])
-        while i > 0 and len(self.spanners[i-1]) <= n:
-            i -= 1
-            n += len(self.spanners[i])
-        self.squash_from(i)
-   
-    def get(self):
-        self.squash_from(0)
-        return clip_spanner(self.length, self.spanners[0])
-
-
-def bedgraph(filename, spanners):
-    with open(filename,"wb") as f:
-        print >> f, "track type=bedGraph"
-        for name, spanner in spanners:
-            pos = 0
-            for length, value in spanner:
-                #if value != 0:
-                print >> f, "{}\t{}\t{}\t{}".format(name,pos,pos+length,value)
-                pos = pos + length
+        self._add_events(numpy.array(self.buffer_positions, 'int64'), numpy.array(self.buffer_deltas))
+        self.buffer_positions = [ ]
+        self.buffer_deltas = [ ]
+    
+    def _add_events(self, positions, deltas):
+        positions = numpy.concatenate([ self.positions, positions ])
+        deltas = numpy.concatenate([ self.deltas, deltas ])
+        positions, index = numpy.unique(positions, return_inverse=True)
+        summed = numpy.bincount(index, deltas, len(positions))
+        if deltas.dtype.kind in 'iu':
+            summed = summed.astype('int64')
+        keep = summed != 0
+        self.positions = positions[keep]
+        self.deltas = summed[keep]
+    
+    def merge(self, other):
+        """ Add the depth of another Coverage of the same sequence. """
+        other.compact()
+        self._add_events(other.positions, other.deltas)
+    
+    def depth_at(self, positions):
+        """ Depth at each of an array of positions. """
+        self.compact()
+        # depth[i] is depth after the first i breakpoints
+        depth = numpy.concatenate([ [0], numpy.cumsum(self.deltas) ]).astype(self.deltas.dtype)
+        return depth[numpy.searchsorted(self.positions, positions, 'right')]
+    
+    def runs(self):
+        """ Depth as runs of equal value covering [0,length).
+            Returns arrays (starts, ends, values). """
+        self.compact()
+        starts = _run_starts(self.length, self.positions)
+        return _merge_runs(self.length, starts, self.depth_at(starts))
+
+
+def _run_starts(length, *breakpoints):
+    """ Starts of runs covering [0,length) with the given breakpoints. """
+    if length <= 0:
+        return numpy.zeros(0, 'int64')
+    positions = numpy.unique(numpy.concatenate([ [0] ] + list(breakpoints)).astype('int64'))
+    return positions[positions < length]
+
+
+def _merge_runs(length, starts, values):
+    """ Runs (starts, ends, values) from values at run starts, merging runs of equal value. """
+    change = numpy.ones(len(starts), bool)
+    change[1:] = values[1:] != values[:-1]
+    starts = starts[change]
+    values = values[change]
+    ends = numpy.concatenate([ starts[1:], [length] ]).astype('int64')
+    return starts, ends, values
+
+
+def coverage_sections(chrom_names, chrom_sizes, pilers, scale=1.0):
+    """ Encode Coverage for each chromosome for bigwig_writer.write_bigwig(). """
+    for i, name in enumerate(chrom_names):
+        starts, ends, values = pilers[name].runs()
+        yield bigwig_writer.encode_chromosome(i, chrom_sizes[i], starts, ends, values*scale)
 
 
 def alignment_is_polya(al):
     return any( item.startswith("AA:i:") for item in al.extra )
 
 
-def iter_fragments(alf):
+def iter_fragments(alf, coordinate_sorted=False):
+    """ Pair up mates, yielding [ alignment ] or [ mate, alignment ].
+    
+        Unpaired alignments are held in a pool until their mate is seen.
+        If coordinate_sorted, an alignment is given up on (yielded by itself) 
+        once its mate's position has been passed, so the pool only holds 
+        alignments whose mate is still ahead. Otherwise, or if alignments 
+        turn out not to be in coordinate order, unmatched alignments are 
+        yielded at the end.
+        """
     pool = { }
+    pool_size = 0
+    peak_pool_size = 0
+    n_evicted = 0
+    
+    # Reference sequences in order of first appearance
+    ref_rank = { }
+    # (rank, mate position, mate key) for pooled alignments with mate on a seen reference
+    heap = [ ]
+    # Mate keys of pooled alignments with mate on a reference not yet seen
+    waiting = { }
+    sorted_order = coordinate_sorted
+    last = None
+    
     for item in alf:
         if item.is_unmapped or item.is_secondary or item.is_supplementary:
             continue
+        
+        if sorted_order:
+            if item.reference_name not in ref_rank:
+                ref_rank[item.reference_name] = len(ref_rank)
+                for key in waiting.pop(item.reference_name, [ ]):
+                    heapq.heappush(heap, (ref_rank[item.reference_name], key[2], key))
+            
+            here = (ref_rank[item.reference_name], item.reference_start)
+            if last is not None and here < last:
+                print "Alignments not in coordinate order, mate pool eviction disabled"
+                sorted_order = False
+                heap = [ ]
+                waiting = { }
+            last = here
+        
+        if sorted_order:
+            while heap and heap[0][:2] < here:
+                key = heapq.heappop(heap)[2]
+                if key in pool:
+                    mate = pool[key].pop()
+                    if not pool[key]: del pool[key]
+                    pool_size -= 1
+                    n_evicted += 1
+                    yield [mate]
     
         if not item.is_proper_pair or item.mate_is_unmapped:
             yield [item]
@@ -118,86 +180,245 @@ def iter_fragments(alf):
         if my_key in pool:
             mate = pool[my_key].pop()
             if not pool[my_key]: del pool[my_key]
+            pool_size -= 1
             yield [ mate, item ]
             continue
         
         mate_key = (item.query_name, item.next_reference_name, item.next_reference_start, item.mate_is_reverse)
         if mate_key not in pool: pool[mate_key] = [ ]
         pool[mate_key].append(item)
+        pool_size += 1
+        peak_pool_size = max(peak_pool_size, pool_size)
+        
+        if sorted_order:
+            if mate_key[1] in ref_rank:
+                heapq.heappush(heap, (ref_rank[mate_key[1]], mate_key[2], mate_key))
+            else:
+                waiting.setdefault(mate_key[1], [ ]).append(mate_key)
     
-    if len(pool): print len(pool), "items left in pool"
+    if pool_size or n_evicted: 
+        print pool_size + n_evicted, "items without mates, peak pool size", peak_pool_size
     for items in pool.itervalues():
         for item in items:
             yield [item]
 
 
-
-def make_bigwig(prefix, bam_filenames, make_spanner, fragments=False, stop_after=None, scale=1.0, polya=False): 
-    header = sam.parsed_bam_headers(bam_filenames[0])
+def pile_tracks(bam_filenames, tracks, stop_after=None, regions=None):
+    """ Calculate coverage for several tracks in a single pass through the BAM files.
     
-    with open(prefix+"-chrom.sizes","wb") as f:
-        for entry in header["SQ"]:
-            f.write("{}\t{}\n".format(entry["SN"],entry["LN"]))
+        tracks - [ (make_spanner, fragments, polya) ]
+            make_spanner is given an alignment, or a fragment if fragments is true.
+        
+        stop_after - stop after this many alignments in each BAM file.
+        
+        regions - only use alignments to these reference sequences, 
+            streamed from indexed BAM files. stop_after then applies to each.
+        
+        Returns chrom_names, chrom_sizes, and for each track a pair of
+        { chrom_name : Coverage } for the forward and reverse strands.
+        """
+    chrom_names, chrom_sizes = _chromosomes(bam_filenames)
+    coordinate_sorted = _is_coordinate_sorted(bam_filenames)
+
+    # For each track: forward, reverse
+    pilers = [ 
+        [ dict([ (i,Coverage(j)) for i,j in zip(chrom_names,chrom_sizes) ]) for strand in (0,1) ]
+        for track in tracks ]
     
-    chrom_names = [ entry["SN"] for entry in header["SQ"] ]
-    chrom_sizes = [ int(entry["LN"]) for entry in header["SQ"] ]
-
-    #alf.close()
-
-    forward = dict([ (i,Piler(j)) for i,j in zip(chrom_names,chrom_sizes) ])
-    reverse = dict([ (i,Piler(j)) for i,j in zip(chrom_names,chrom_sizes) ])
+    read_tracks = [ (make_spanner,polya,track_pilers) 
+        for (make_spanner,fragments,polya), track_pilers in zip(tracks, pilers) if not fragments ]
+    fragment_tracks = [ (make_spanner,polya,track_pilers) 
+        for (make_spanner,fragments,polya), track_pilers in zip(tracks, pilers) if fragments ]
     
     old = grace.status("Bigwig")
-
-    for filename in bam_filenames:
-        alf = sam.Bam_reader(filename)
-        
-        n = 0
+    
+    for filename, region in _sources(bam_filenames, regions):
+        alf = _reader(filename, region)
         
-        if not fragments:
+        def alignments():
+            n = 0
             for item in alf:
                 if item.is_unmapped or item.is_secondary or item.is_supplementary:
                     continue
-                    
-                if polya and not alignment_is_polya(item):
-                    continue
-            
-                # Assume --> <-- oriented read pairs
-                which = forward if bool(item.is_reverse) == bool(item.is_read2) else reverse
-                which[item.reference_name].add( make_spanner(item) )
+                
+                if read_tracks:
+                    is_polya = alignment_is_polya(item)
+                    # Assume --> <-- oriented read pairs
+                    which = 0 if bool(item.is_reverse) == bool(item.is_read2) else 1
+                    for make_spanner, polya, track_pilers in read_tracks:
+                        if polya and not is_polya: continue
+                        track_pilers[which][item.reference_name].add( make_spanner(item) )
+                
+                yield item
                     
                 n += 1
-                if stop_after is not None and n > stop_after: break
-                if n % 1000000 == 0: grace.status(os.path.basename(prefix)+" "+filename+" "+grace.pretty_number(n))
+                if stop_after is not None and n >= stop_after: break
+                if n % 1000000 == 0: grace.status("Bigwig "+filename+" "+grace.pretty_number(n))
+        
+        if not fragment_tracks:
+            for item in alignments(): 
+                pass
         
         else:
-            for item in iter_fragments(alf):
-                if polya and not any(alignment_is_polya(al) for al in item):
-                    continue
-            
+            for item in iter_fragments(alignments(), coordinate_sorted):
+                is_polya = any(alignment_is_polya(al) for al in item)
                 # Assume --> <-- oriented read pairs
-                which = forward if bool(item[0].is_reverse) == bool(item[0].is_read2) else reverse
-                which[item[0].reference_name].add( make_spanner(item) )
-                    
-                n += 1
-                if stop_after is not None and n > stop_after: break
-                if n % 1000000 == 0: grace.status(os.path.basename(prefix)+" "+filename+" "+grace.pretty_number(n))
+                which = 0 if bool(item[0].is_reverse) == bool(item[0].is_read2) else 1
+                for make_spanner, polya, track_pilers in fragment_tracks:
+                    if polya and not is_polya: continue
+                    track_pilers[which][item[0].reference_name].add( make_spanner(item) )
         
         alf.close()
+    
+    grace.status(old)
+    
+    return chrom_names, chrom_sizes, pilers
 
-    bedgraph(prefix+"-fwd.bedgraph", zip(chrom_names, [ scale_spanner(scale, forward[item].get()) for item in chrom_names ]))
-    subprocess.check_call([
-        "wigToBigWig",prefix+"-fwd.bedgraph",prefix+"-chrom.sizes",prefix+"-fwd.bw"])
-    os.unlink(prefix+"-fwd.bedgraph")
+
+def write_track(prefix, chrom_names, chrom_sizes, track_pilers, scale=1.0):
+    """ Write prefix-fwd.bw and prefix-rev.bw from a track produced by pile_tracks(). """
+    for suffix, strand_pilers in zip([ "-fwd.bw", "-rev.bw" ], track_pilers):
+        bigwig_writer.write_bigwig(prefix+suffix, chrom_names, chrom_sizes,
+            coverage_sections(chrom_names, chrom_sizes, strand_pilers, scale))
+
+
+def make_bigwigs(bam_filenames, tracks, stop_after=None, scale=1.0, by_chromosome=False):
+    """ Make several bigwigs in a single pass through the BAM files.
+    
+        tracks - [ (prefix, make_spanner, fragments, polya) ]
+            Produces prefix-fwd.bw and prefix-rev.bw for each track.
         
-    bedgraph(prefix+"-rev.bedgraph", zip(chrom_names, [ scale_spanner(scale, reverse[item].get()) for item in chrom_names ]))    
+        by_chromosome - process reference sequences in parallel workers, 
+            using the BAM index. Small sequences are batched together. stop_after then applies to each reference sequence.
+        """
+    if by_chromosome:
+        chrom_names, chrom_sizes = _chromosomes(bam_filenames)
+        outputs = [ track[0]+suffix for track in tracks for suffix in ("-fwd.bw","-rev.bw") ]
+        with workspace.tempspace() as temp:
+            for item in legion.parallel_imap(_pile_tracks_chromosomes, _chromosome_batches(chrom_sizes),
+                    temp.working_dir, bam_filenames, [ track[1:] for track in tracks ], stop_after, scale):
+                pass
+            _assemble_chromosomes(temp.working_dir, outputs, chrom_names, chrom_sizes)
+        return
+    
+    chrom_names, chrom_sizes, pilers = pile_tracks(
+        bam_filenames, [ track[1:] for track in tracks ], stop_after=stop_after)
+    for track, track_pilers in zip(tracks, pilers):
+        write_track(track[0], chrom_names, chrom_sizes, track_pilers, scale)
+
+
+def _chromosomes(bam_filenames):
+    header = sam.parsed_bam_headers(bam_filenames[0])
+    chrom_names = [ entry["SN"] for entry in header["SQ"] ]
+    chrom_sizes = [ int(entry["LN"]) for entry in header["SQ"] ]
+    return chrom_names, chrom_sizes
+
+
+def _is_coordinate_sorted(bam_filenames):
+    for filename in bam_filenames:
+        header = sam.parsed_bam_headers(filename)
+        if not header.get("HD") or header["HD"][0].get("SO") != "coordinate":
+            return False
+    return True
+
+
+def preview_bam(filename, out_filename, fraction, seed=1, index=False):
+    """ Write a random subsample of reads from a BAM file, for quick previews.
+    
+        Reads are chosen by samtools using a seeded hash of the read name,
+        so mates are kept together and only chosen reads need to be decoded.
+        The output is uncompressed. Returns out_filename.
+        """
+    # samtools takes the seed and fraction together as SEED.FRACTION
+    fraction_text = ("%.15f" % fraction).rstrip("0")
+    assert fraction_text.startswith("0.") and fraction_text != "0.", \
+        "Preview fraction should be between 0 and 1."
     subprocess.check_call([
-        "wigToBigWig",prefix+"-rev.bedgraph",prefix+"-chrom.sizes",prefix+"-rev.bw"])
-    os.unlink(prefix+"-rev.bedgraph")
+        "samtools","view","-u","-s","%d%s" % (seed, fraction_text[1:]),
+        "-o",out_filename,filename])
+    if index:
+        subprocess.check_call(["samtools","index",out_filename])
+    return out_filename
+
+
+class _Region_reader(sam.Bam_reader):
+    """ Alignments to one reference sequence, streamed by samtools using the BAM index. """
+    def __init__(self, filename, chrom_name):
+        assert os.path.exists(filename), filename + ' does not exist'
+        self.process = io.run([ 'samtools', 'view', io.abspath(filename), chrom_name ])
+        self.file = self.process.stdout
+
+
+def _reader(filename, region):
+    if region is None:
+        return sam.Bam_reader(filename)
+    return _Region_reader(filename, region)
+
+
+def _sources(bam_filenames, regions):
+    """ (filename, region) pairs to read, region being None for a whole file. """
+    if regions is None:
+        return [ (filename, None) for filename in bam_filenames ]
+    return [ (filename, region) for filename in bam_filenames for region in regions ]
+
+
+def _chromosome_batches(chrom_sizes, n_batches=64):
+    """ Group consecutive reference sequences into tasks for by_chromosome workers.
+        Small sequences such as unplaced scaffolds share a task, 
+        large sequences get a task each. """
+    target = sum(chrom_sizes) / float(n_batches)
+    batches = [ ]
+    batch = [ ]
+    size = 0
+    for chrom_id, chrom_size in enumerate(chrom_sizes):
+        batch.append(chrom_id)
+        size += chrom_size
+        if size >= target:
+            batches.append(batch)
+            batch = [ ]
+            size = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _save_section(temp_dir, chrom_id, output_id, section):
+    with open(os.path.join(temp_dir, "section-%d-%d.pickle" % (chrom_id, output_id)),"wb") as f:
+        pickle.dump(section, f, pickle.HIGHEST_PROTOCOL)
+
+
+def _assemble_chromosomes(temp_dir, outputs, chrom_names, chrom_sizes):
+    """ Write bigwigs from sections saved by _save_section, in header order. """
+    def sections(output_id):
+        for chrom_id in xrange(len(chrom_names)):
+            filename = os.path.join(temp_dir, "section-%d-%d.pickle" % (chrom_id, output_id))
+            with open(filename,"rb") as f:
+                section = pickle.load(f)
+            os.unlink(filename)
+            yield section
     
-    os.unlink(prefix+"-chrom.sizes")
+    for output_id, output in enumerate(outputs):
+        bigwig_writer.write_bigwig(output, chrom_names, chrom_sizes, sections(output_id))
+
+
+def _pile_tracks_chromosomes(chrom_ids, temp_dir, bam_filenames, tracks, stop_after, scale):
+    """ Worker for make_bigwigs(by_chromosome=True). """
+    chrom_names, chrom_sizes = _chromosomes(bam_filenames)
+    chrom_names, chrom_sizes, pilers = pile_tracks(bam_filenames, tracks, stop_after=stop_after, 
+        regions=[ chrom_names[chrom_id] for chrom_id in chrom_ids ])
     
-    grace.status(old)
+    for chrom_id in chrom_ids:
+        output_id = 0
+        for track_pilers in pilers:
+            for strand_pilers in track_pilers:
+                starts, ends, values = strand_pilers[chrom_names[chrom_id]].runs()
+                _save_section(temp_dir, chrom_id, output_id, 
+                    bigwig_writer.encode_chromosome(chrom_id, chrom_sizes[chrom_id], starts, ends, values*scale))
+                output_id += 1
+
+
+def make_bigwig(prefix, bam_filenames, make_spanner, fragments=False, stop_after=None, scale=1.0, polya=False): 
+    make_bigwigs(bam_filenames, [ (prefix, make_spanner, fragments, polya) ], stop_after=stop_after, scale=scale)
 
 
 def read2_starts(item):
@@ -259,96 +480,181 @@ def fragment_coverage(items):
 
 
 
-def make_ambiguity_bigwig(prefix, bam_filenames, stop_after=None, subsample=1): 
-    header = sam.parsed_bam_headers(bam_filenames[0])
+# Tracks that can be made by make_bigwigs, name : (make_spanner, fragments, polya)
+TRACKS = {
+    "cover" : (fragment_split_coverage, True, False),
+    "span" : (fragment_coverage, True, False),
+    "start" : (read1_starts, False, False),
+    "end" : (read2_starts, False, False),
+    "5p" : (read_starts, False, False),
+    "3p" : (read_ends, False, False),
+    "polyacover" : (fragment_split_coverage, True, True),
+    "polyaspan" : (fragment_coverage, True, True),
+    "polya3p" : (read_ends, False, True),
+    }
+
+
+
+def make_sample_bigwigs(prefix, bam_filename, what, scales, coverage_filename=None, coverage_what=[ ]):
+    """ Make bigwigs for a sample, at several scalings, from a single calculation of coverage.
+    
+        Produces prefix-<scale name>-<track>-fwd.bw and -rev.bw
+        for each (scale name, scale) in scales and each track in what.
+        
+        Coverage for tracks in coverage_what is saved to coverage_filename, 
+        for use by make_total_bigwigs().
+        """
+    names = list(what) + [ item for item in coverage_what if item not in what ]
+    chrom_names, chrom_sizes, pilers = pile_tracks([bam_filename], [ TRACKS[item] for item in names ])
     
-    with open(prefix+"-chrom.sizes","wb") as f:
-        for entry in header["SQ"]:
-            f.write("{}\t{}\n".format(entry["SN"],entry["LN"]))
+    for name, track_pilers in zip(names, pilers):
+        if name not in what: continue
+        for scale_name, scale in scales:
+            write_track(prefix+"-"+scale_name+"-"+name, chrom_names, chrom_sizes, track_pilers, scale)
     
-    chrom_names = [ entry["SN"] for entry in header["SQ"] ]
-    chrom_sizes = [ int(entry["LN"]) for entry in header["SQ"] ]
+    if coverage_filename:
+        save_coverage(coverage_filename, chrom_names, chrom_sizes, 
+            dict( item for item in zip(names, pilers) if item[0] in coverage_what ))
 
-    unambiguous = dict([ (i,Piler(j)) for i,j in zip(chrom_names,chrom_sizes) ])
-    total = dict([ (i,Piler(j)) for i,j in zip(chrom_names,chrom_sizes) ])
 
-    for filename in bam_filenames:
-        alf = sam.Bam_reader(filename)
-        n = 0
-        
-        sub = subsample-1
-        for item in alf:
-            if item.is_unmapped or item.is_supplementary:
-                continue
-        
-            sub = (sub + 1) % subsample
-            if sub: continue
+def make_total_bigwigs(prefix, coverage_filenames, what):
+    """ Sum coverage saved by make_sample_bigwigs(), 
+        producing prefix-<track>-fwd.bw and -rev.bw for each track in what. """
+    totals = None
+    for filename in coverage_filenames:
+        chrom_names, chrom_sizes, sample_pilers = load_coverage(filename)
         
-            spanner = fragment_split_coverage([item])
-            #spanner = fragment_coverage([item])        #TODO fixme when blocks available
-            total[item.reference_name].add(spanner)
-            
-            NH = 1
-            for item2 in item.extra:
-                if item2.startswith("NH:i:"):
-                    NH = int(item2[5:])
-            if NH == 1:
-                unambiguous[item.reference_name].add(spanner)
-                
-            n += 1
-            if stop_after is not None and n > stop_after: break
-            if n % 1000000 == 0: print prefix, filename, grace.pretty_number(n)
+        if totals is None:
+            totals = sample_pilers
+            continue
         
-        alf.close()
-
-
-    ambiguities = [ ]
-    for i in xrange(len(total)):
-        u = unambiguous[chrom_names[i]].get()
-        t = map_spanner(lambda x: x*1j, total[chrom_names[i]].get())
-        c = pile([u,t],initial=0.0)
-        c = map_spanner(lambda x: max(0.0,x.imag-x.real)/max(x.imag,1.0), c)
-        ambiguities.append(c)
-
-    bedgraph(prefix+".bedgraph", zip(chrom_names, [ item for item in ambiguities ]))
-    subprocess.check_call([
-        "wigToBigWig",prefix+".bedgraph",prefix+"-chrom.sizes",prefix+".bw"])
-    os.unlink(prefix+".bedgraph")
-    os.unlink(prefix+"-chrom.sizes")
-
-
-
-def make_ambiguity_bigwig_by_readname(prefix, bam_filenames, stop_after=None, subsample=1): 
-    #import pysam
+        for name in what:
+            for strand_totals, strand_pilers in zip(totals[name], sample_pilers[name]):
+                for chrom_name in chrom_names:
+                    strand_totals[chrom_name].merge(strand_pilers[chrom_name])
+        del sample_pilers
     
-    #alf = pysam.AlignmentFile(bam_filenames[0])
-    #header = alf.header
-    header = sam.parsed_bam_headers(bam_filenames[0])
+    for name in what:
+        write_track(prefix+"-"+name, chrom_names, chrom_sizes, totals[name])
+
+
+# Increment if the coverage file format changes
+COVERAGE_VERSION = 1
+
+def save_coverage(filename, chrom_names, chrom_sizes, tracks):
+    """ Save tracks, { name : [ { chrom_name : Coverage } for each strand ] },
+        as a numpy .npz file. Coverage is stored as breakpoints, 
+        arrays of positions and changes in depth. """
+    arrays = { }
+    names = sorted(tracks)
+    for i, name in enumerate(names):
+        for j, strand_pilers in enumerate(tracks[name]):
+            for k, chrom_name in enumerate(chrom_names):
+                coverage = strand_pilers[chrom_name]
+                coverage.compact()
+                arrays["positions_%d_%d_%d" % (i,j,k)] = coverage.positions
+                arrays["deltas_%d_%d_%d" % (i,j,k)] = coverage.deltas
     
-    with open(prefix+"-chrom.sizes","wb") as f:
-        for entry in header["SQ"]:
-            f.write("{}\t{}\n".format(entry["SN"],entry["LN"]))
+    with open(filename,"wb") as f:
+        numpy.savez(f, 
+            version=numpy.array([COVERAGE_VERSION]),
+            chrom_names=numpy.array(chrom_names, 'S'),
+            chrom_sizes=numpy.array(chrom_sizes, 'int64'),
+            names=numpy.array(names, 'S'),
+            strands=numpy.array([ len(tracks[name]) for name in names ], 'int64'),
+            **arrays)
+
+
+def load_coverage(filename):
+    """ Load coverage saved by save_coverage(). 
+        Returns chrom_names, chrom_sizes, { name : [ { chrom_name : Coverage } for each strand ] } """
+    data = numpy.load(filename)
+    if data["version"][0] != COVERAGE_VERSION:
+        raise config.Error("%s was written by a different version of Tail Tools, please remake it." % filename)
     
-    chrom_names = [ entry["SN"] for entry in header["SQ"] ]
-    chrom_sizes = [ int(entry["LN"]) for entry in header["SQ"] ]
-
-    #alf.close()
-
-    unambiguous = dict([ (i,Piler(j)) for i,j in zip(chrom_names,chrom_sizes) ])
-    total = dict([ (i,Piler(j)) for i,j in zip(chrom_names,chrom_sizes) ])
+    chrom_names = data["chrom_names"].tolist()
+    chrom_sizes = data["chrom_sizes"].tolist()
+    tracks = { }
+    for i, (name, n_strands) in enumerate(zip(data["names"].tolist(), data["strands"].tolist())):
+        tracks[name] = [ ]
+        for j in xrange(n_strands):
+            strand_pilers = { }
+            for k, (chrom_name, chrom_size) in enumerate(zip(chrom_names, chrom_sizes)):
+                coverage = Coverage(chrom_size)
+                coverage.positions = data["positions_%d_%d_%d" % (i,j,k)]
+                coverage.deltas = data["deltas_%d_%d_%d" % (i,j,k)]
+                strand_pilers[chrom_name] = coverage
+            tracks[name].append(strand_pilers)
+    return chrom_names, chrom_sizes, tracks
+
+
+def make_ambiguity_bigwig(prefix, bam_filenames, stop_after=None, subsample=1, by_chromosome=False, by_readname=False): 
+    """ Bigwig of the proportion of reads that are multi-mappers at each base.
+    
+        by_readname - determine ambiguity by grouping alignments by read name,
+            in BAM files sorted by read name. Otherwise the NH attribute is used.
+    
+        by_chromosome - process reference sequences in parallel workers, 
+            using the BAM index. Small sequences are batched together. stop_after and subsample then apply to each reference sequence.
+        """
+    chrom_names, chrom_sizes = _chromosomes(bam_filenames)
+    
+    if by_chromosome:
+        assert not by_readname, "Can't process by chromosome when grouping by read name."
+        with workspace.tempspace() as temp:
+            for item in legion.parallel_imap(_ambiguity_chromosomes, _chromosome_batches(chrom_sizes),
+                    temp.working_dir, bam_filenames, stop_after, subsample):
+                pass
+            _assemble_chromosomes(temp.working_dir, [ prefix+".bw" ], chrom_names, chrom_sizes)
+        return
     
     old = grace.status("Ambiguity bigwig")
+    
+    unambiguous, total = _pile_ambiguity(
+        prefix, bam_filenames, chrom_names, chrom_sizes, stop_after, subsample, by_readname)
+    
+    bigwig_writer.write_bigwig(prefix+".bw", chrom_names, chrom_sizes, 
+        ( bigwig_writer.encode_chromosome(i, chrom_sizes[i], 
+              *ambiguity_runs(unambiguous[chrom_names[i]], total[chrom_names[i]])) 
+          for i in xrange(len(chrom_names)) ))
+    
+    grace.status(old)
 
-    for filename in bam_filenames:
-        #alf = pysam.AlignmentFile(filename)
-        alf = sam.Bam_reader(filename)
-        n = 0
-        
-        sub = subsample-1
+
+def make_ambiguity_bigwig_by_readname(prefix, bam_filenames, stop_after=None, subsample=1): 
+    make_ambiguity_bigwig(prefix, bam_filenames, stop_after, subsample, by_readname=True)
+
+
+def _ambiguity_chromosomes(chrom_ids, temp_dir, bam_filenames, stop_after, subsample):
+    """ Worker for make_ambiguity_bigwig(by_chromosome=True). """
+    chrom_names, chrom_sizes = _chromosomes(bam_filenames)
+    regions = [ chrom_names[chrom_id] for chrom_id in chrom_ids ]
+    unambiguous, total = _pile_ambiguity(
+        regions[0], bam_filenames, chrom_names, chrom_sizes, stop_after, subsample, regions=regions)
+    
+    for chrom_id, chrom_name in zip(chrom_ids, regions):
+        _save_section(temp_dir, chrom_id, 0,
+            bigwig_writer.encode_chromosome(chrom_id, chrom_sizes[chrom_id],
+                *ambiguity_runs(unambiguous[chrom_name], total[chrom_name])))
+
+
+def ambiguity_runs(unambiguous, total):
+    """ Proportion of total depth that is not unambiguous depth, 
+        from two Coverages of the same sequence.
+        Returns runs as arrays (starts, ends, values). """
+    unambiguous.compact()
+    total.compact()
+    starts = _run_starts(total.length, unambiguous.positions, total.positions)
+    u = unambiguous.depth_at(starts)
+    t = total.depth_at(starts)
+    values = numpy.maximum(0.0, t-u) / numpy.maximum(t, 1.0)
+    return _merge_runs(total.length, starts, values)
+
+
+def _alignment_groups(alf, by_readname):
+    """ Groups of alignments of the same read, and whether they are ambiguous. """
+    if by_readname:
         for (key,items) in itertools.groupby(alf, lambda item: item.query_name):
-            sub = (sub + 1) % subsample
-            if sub: continue
-        
             items = [ item for item in items if not item.is_unmapped and not item.is_supplementary ]
             if not items:
                 continue
@@ -357,13 +663,43 @@ def make_ambiguity_bigwig_by_readname(prefix, bam_filenames, stop_after=None, su
             AS = [ item.get_AS() for item in items ]
             best_AS = max(AS)
             items = [ item for item, this_AS in zip(items,AS) if this_AS >= best_AS ]
+            yield items, len(items) > 1
+    
+    else:
+        for item in alf:
+            if item.is_unmapped or item.is_supplementary:
+                continue
+            
+            NH = 1
+            for item2 in item.extra:
+                if item2.startswith("NH:i:"):
+                    NH = int(item2[5:])
+            yield [ item ], NH != 1
+
+
+def _pile_ambiguity(prefix, bam_filenames, chrom_names, chrom_sizes, stop_after, subsample, by_readname=False, regions=None):
+    """ Coverage by unambiguous and by all alignments.
+        Grouped by read name, alignments of a read are weighted equally and sum to one.
+        regions is as for pile_tracks(). """
+    unambiguous = dict([ (i,Coverage(j)) for i,j in zip(chrom_names,chrom_sizes) ])
+    total = dict([ (i,Coverage(j)) for i,j in zip(chrom_names,chrom_sizes) ])
+
+    for filename, region in _sources(bam_filenames, regions):
+        alf = _reader(filename, region)
+        n = 0
         
+        sub = subsample-1
+        for items, ambiguous in _alignment_groups(alf, by_readname):
+            sub = (sub + 1) % subsample
+            if sub: continue
+            
             for item in items:
                 spanner = fragment_split_coverage([item])
                 #spanner = fragment_coverage([item])        #TODO fixme when blocks available
-                spanner = scale_spanner(1.0/len(items), spanner)
+                if by_readname:
+                    spanner = scale_spanner(1.0/len(items), spanner)
                 total[item.reference_name].add(spanner)
-                if len(items) == 1:
+                if not ambiguous:
                     unambiguous[item.reference_name].add(spanner)
                 
             n += 1
@@ -371,23 +707,8 @@ def make_ambiguity_bigwig_by_readname(prefix, bam_filenames, stop_after=None, su
             if n % 1000000 == 0: grace.status(os.path.basename(prefix)+" "+filename+" "+grace.pretty_number(n))
         
         alf.close()
-
-
-    ambiguities = [ ]
-    for i in xrange(len(total)):
-        u = unambiguous[chrom_names[i]].get()
-        t = map_spanner(lambda x: x*1j, total[chrom_names[i]].get())
-        c = pile([u,t],initial=0.0)
-        c = map_spanner(lambda x: max(0.0,x.imag-x.real)/max(x.imag,1.0), c)
-        ambiguities.append(c)
-
-    bedgraph(prefix+".bedgraph", zip(chrom_names, [ item for item in ambiguities ]))
-    subprocess.check_call([
-        "wigToBigWig",prefix+".bedgraph",prefix+"-chrom.sizes",prefix+".bw"])
-    os.unlink(prefix+".bedgraph")
-    os.unlink(prefix+"-chrom.sizes")
     
-    grace.status(old)
+    return unambiguous, total
 
 
 
@@ -408,47 +729,47 @@ ambiguity - What proportion of reads are multi-mappers at each base, using NH at
 @config.String_flag("what", "What bigwig files to actually produce. Comma separated list.")
 @config.Int_flag("subsample", "(currently for ambiguity plots only) Subsample alignments by this factor.")
 @config.Float_flag("scale", "Scale output by this (eg a normalizing multiplier).")
+@config.Bool_flag("by_chromosome", "Process reference sequences in parallel, small ones batched together. BAM files must be sorted and indexed.")
+@config.Float_flag("preview", 
+    "Quick preview: use only this fraction of reads, chosen by samtools using a seeded hash of the read name "
+    "(so mates are kept together). Output is scaled up accordingly. 0 to use all reads.")
 class Bam_to_bigwig(config.Action_with_prefix):
     what = "cover,span,start,end,ambiguity"
     subsample = 1
     scale = 1.0
+    by_chromosome = False
+    preview = 0.0
     bam_files = [ ]
     
     def run(self):
+        if not self.preview:
+            self._make(self.bam_files, self.scale)
+            return
+        
+        with workspace.tempspace() as temp:
+            bam_files = [ 
+                preview_bam(filename, temp/("preview-%d.bam" % i), self.preview, index=self.by_chromosome)
+                for i, filename in enumerate(self.bam_files) ]
+            self._make(bam_files, self.scale / self.preview)
+    
+    def _make(self, bam_files, scale):
+        tracks = [ ]
         with nesoni.Stage() as stage:
             for item in self.what.split(","):
-                if item == "cover":
-                    stage.process(make_bigwig,
-                        self.prefix + "-cover", self.bam_files, fragment_split_coverage, True, scale=self.scale)
-                elif item == "span":
-                    stage.process(make_bigwig,
-                        self.prefix + "-span", self.bam_files, fragment_coverage, True, scale=self.scale)
-                elif item == "start":
-                    stage.process(make_bigwig,
-                        self.prefix + "-start", self.bam_files, read1_starts, False, scale=self.scale)
-                elif item == "end":
-                    stage.process(make_bigwig,
-                        self.prefix + "-end", self.bam_files, read2_starts, False, scale=self.scale)
-                elif item == "5p":
-                    stage.process(make_bigwig,
-                        self.prefix + "-5p", self.bam_files, read_starts, False, scale=self.scale)
-                elif item == "3p":
-                    stage.process(make_bigwig,
-                        self.prefix + "-3p", self.bam_files, read_ends, False, scale=self.scale)
-                elif item == "polyacover":
-                    stage.process(make_bigwig,
-                        self.prefix + "-polyacover", self.bam_files, fragment_split_coverage, True, scale=self.scale, polya=True)
-                elif item == "polyaspan":
-                    stage.process(make_bigwig,
-                        self.prefix + "-polyaspan", self.bam_files, fragment_coverage, True, scale=self.scale, polya=True)
-                elif item == "polya3p":
-                    stage.process(make_bigwig,
-                        self.prefix + "-polya3p", self.bam_files, read_ends, False, scale=self.scale, polya=True)
+                if item in TRACKS:
+                    make_spanner, fragments, polya = TRACKS[item]
+                    tracks.append((self.prefix + "-" + item, make_spanner, fragments, polya))
                 elif item == "ambiguity":
                     stage.process(make_ambiguity_bigwig,
-                        self.prefix + "-ambiguity", self.bam_files, subsample=self.subsample)
+                        self.prefix + "-ambiguity", bam_files, subsample=self.subsample,
+                        by_chromosome=self.by_chromosome)
                 else:
                     raise config.Error("Don't know how to make: "+item)
+            
+            # All other tracks are made in a single pass through the BAM files
+            if tracks:
+                stage.process(make_bigwigs, bam_files, tracks, scale=scale, 
+                    by_chromosome=self.by_chromosome)
 
 
 @config.help("Produce ambiguity bigwig from a BAM file.", """\
@@ -463,8 +784,43 @@ class Bam_ambiguity(config.Action_with_prefix):
     bam_files = [ ]
     
     def run(self):
-        (make_ambiguity_bigwig_by_readname if self.by_readname else make_ambiguity_bigwig) \
-            (self.prefix, self.bam_files, subsample=self.subsample)
+        make_ambiguity_bigwig(self.prefix, self.bam_files, subsample=self.subsample, by_readname=self.by_readname)
+
+
+@config.help("Produce bigwig files for one sample, raw and optionally normalized, from a single calculation of coverage.", """\
+Produces <prefix>-raw-<track>-fwd.bw and -rev.bw for each track, and -norm- tracks if --norm is given. \
+Coverage of --coverage-what tracks is kept in --coverage-file, for use by Total_bigwigs.
+""")
+@config.Positional("bam_file", "BAM file.")
+@config.String_flag("what", "Tracks to produce. Comma separated list.")
+@config.Float_flag("norm", "Normalizing multiplier. 0 for no normalized tracks.")
+@config.String_flag("coverage_what", "Tracks to keep coverage of. Comma separated list.")
+@config.String_flag("coverage_file", "File to keep coverage in (.npz format), see save_coverage().")
+class Sample_bigwigs(config.Action_with_prefix):
+    bam_file = None
+    what = "cover,3p,polyacover,polya3p"
+    norm = 0.0
+    coverage_what = ""
+    coverage_file = None
+    
+    def run(self):
+        scales = [("raw",1.0)] + ([("norm",self.norm)] if self.norm else [])
+        coverage_what = self.coverage_what.split(",") if self.coverage_what else [ ]
+        make_sample_bigwigs(self.prefix, self.bam_file, self.what.split(","), scales,
+            self.coverage_file if coverage_what else None, coverage_what)
+
+
+@config.help("Produce total bigwig files from coverage kept by Sample_bigwigs.", """\
+Produces <prefix>-<track>-fwd.bw and -rev.bw for each track.
+""")
+@config.String_flag("what", "Tracks to produce. Comma separated list.")
+@config.Main_section("coverage_files", "Coverage files kept by Sample_bigwigs.")
+class Total_bigwigs(config.Action_with_prefix):
+    what = "cover,3p,polyaspan,polya3p"
+    coverage_files = [ ]
+    
+    def run(self):
+        make_total_bigwigs(self.prefix, self.coverage_files, self.what.split(","))
 
 
 @config.help("Create a set of bigwig files based on pipeline output.")
@@ -522,19 +878,32 @@ class Polya_bigwigs(config.Action_with_output_dir):
             mults = io.read_grouped_table(self.norm_file)['All']
             norm_mult = [ float(mults[name]['Normalizing.multiplier']) for name in sample_names ]
         
+        # Sample coverage is calculated once, 
+        # then scaled for normalized tracks and summed for total tracks.
+        # Sample coverage files are kept so total tracks can be remade when samples are up to date.
+        total_what = "cover,3p,polyaspan,polya3p"
+        coverage = io.Workspace(workspace/"coverage", must_exist=False)
+        coverage_files = [ coverage/(name+".npz") for name in sample_names ]
+        
         with nesoni.Stage() as stage:
-            Bam_to_bigwig(workspace/"total", bam_files=bams, what="ambiguity,cover,3p,polyaspan,polya3p",
+            Bam_ambiguity(workspace/"total-ambiguity", bam_files=bams, by_readname=False,
                 ).process_make(stage)
             
             for i in xrange(len(sample_names)):
-                for scale_desc, scale in \
-                        [("raw",1.0)] + \
-                        ([("norm",norm_mult[i])] if self.norm_file else []):
-                    Bam_to_bigwig(
-                        workspace/(sample_names[i]+"-"+scale_desc), 
-                        bam_files=[bams[i]], 
-                        what='cover,3p,polyacover,polya3p', scale=scale
-                        ).process_make(stage)
+                Sample_bigwigs(
+                    workspace/sample_names[i], 
+                    bams[i],
+                    what="cover,3p,polyacover,polya3p",
+                    norm=norm_mult[i] if self.norm_file else 0.0,
+                    coverage_what=total_what,
+                    coverage_file=coverage_files[i],
+                    ).process_make(stage)
+        
+        Total_bigwigs(
+            workspace/"total",
+            coverage_files=coverage_files,
+            what=total_what,
+            ).make()
 
 
 
@@ -0,0 +1,303 @@
+"""
+
+Write bigWig files directly, rather than writing a bedGraph file and calling wigToBigWig.
+
+The layout is that written by UCSC's bedGraphToBigWig (see Kent et al. 2010,
+"BigWig and BigBed: enabling browsing of large distributed datasets"):
+
+    header
+    zoom level headers
+    total summary
+    chromosome B+ tree
+    data: number of blocks, then zlib compressed blocks of bedGraph items
+    R-tree index of data blocks
+    for each zoom level: number of records, compressed blocks of summary records, R-tree index
+
+Each chromosome is encoded separately by encode_chromosome(), so chromosomes
+can be encoded in parallel. write_bigwig() then assembles the file, writing
+data blocks as each chromosome arrives so only the (much smaller) zoom level
+data is held in memory.
+
+"""
+
+import struct, zlib
+
+import numpy
+
+BIGWIG_MAGIC = 0x888FFC26
+BPT_MAGIC = 0x78CA8C91
+CIRTREE_MAGIC = 0x2468ACE0
+
+BLOCK_SIZE = 256
+ITEMS_PER_SLOT = 1024
+
+# Bases per summary record at each zoom level
+ZOOM_REDUCTIONS = [ 256 * 4**i for i in xrange(10) ]
+
+ITEM_DTYPE = numpy.dtype([
+    ('start','<u4'), ('end','<u4'), ('value','<f4') ])
+
+ZOOM_DTYPE = numpy.dtype([
+    ('chrom','<u4'), ('start','<u4'), ('end','<u4'), ('valid','<u4'),
+    ('min','<f4'), ('max','<f4'), ('sum','<f4'), ('sum_squares','<f4') ])
+
+
+class Section(object):
+    """ One chromosome, encoded.
+
+        blocks - [ (start, end, compressed bytes, uncompressed size) ]
+        zoom_blocks - for each zoom level, [ (start, end, compressed bytes, uncompressed size) ]
+        zoom_counts - for each zoom level, number of summary records
+        summary - (bases covered, min, max, sum, sum of squares)
+        """
+    def __init__(self, chrom_id, blocks, zoom_blocks, zoom_counts, summary):
+        self.chrom_id = chrom_id
+        self.blocks = blocks
+        self.zoom_blocks = zoom_blocks
+        self.zoom_counts = zoom_counts
+        self.summary = summary
+
+
+def _integral(starts, ends, weights, x):
+    """ Integral of a step function given as runs from 0 to each of x. """
+    cumulative = numpy.concatenate([ [0.0], numpy.cumsum(weights*(ends-starts)) ])
+    k = numpy.searchsorted(starts, x, 'right')-1
+    k_clip = numpy.maximum(k, 0)
+    within = numpy.clip(x-starts[k_clip], 0, ends[k_clip]-starts[k_clip])
+    return numpy.where(k >= 0, cumulative[k_clip] + weights[k_clip]*within, 0.0)
+
+
+def _zoom_records(chrom_id, size, starts, ends, values, reduction):
+    bin_starts = numpy.arange(0, size, reduction, dtype='int64')
+    bin_ends = numpy.minimum(bin_starts+reduction, size)
+
+    # Runs overlapping each bin are [first, last)
+    first = numpy.searchsorted(ends, bin_starts, 'right')
+    last = numpy.searchsorted(starts, bin_ends, 'left')
+    keep = first < last
+    bin_starts = bin_starts[keep]
+    bin_ends = bin_ends[keep]
+    first = first[keep]
+    last = last[keep]
+
+    records = numpy.zeros(len(bin_starts), ZOOM_DTYPE)
+    if not len(records):
+        return records
+
+    records['chrom'] = chrom_id
+    records['start'] = numpy.maximum(bin_starts, starts[first])
+    records['end'] = numpy.minimum(bin_ends, ends[last-1])
+
+    ones = numpy.ones(len(values))
+    for field, weights in [ ('valid',ones), ('sum',values), ('sum_squares',values*values) ]:
+        records[field] = (
+            _integral(starts, ends, weights, bin_ends) -
+            _integral(starts, ends, weights, bin_starts) )
+
+    # Sentinel allows last to equal len(values). Odd numbered reductions are discarded.
+    padded = numpy.concatenate([ values, [0.0] ])
+    bounds = numpy.empty(len(first)*2, 'int64')
+    bounds[0::2] = first
+    bounds[1::2] = last
+    records['min'] = numpy.minimum.reduceat(padded, bounds)[0::2]
+    records['max'] = numpy.maximum.reduceat(padded, bounds)[0::2]
+    return records
+
+
+def _blocks(header_func, items):
+    """ Split an array of items into compressed blocks. """
+    result = [ ]
+    for i in xrange(0, len(items), ITEMS_PER_SLOT):
+        chunk = items[i:i+ITEMS_PER_SLOT]
+        data = header_func(chunk) + chunk.tobytes()
+        result.append((int(chunk['start'][0]), int(chunk['end'][-1]), zlib.compress(data), len(data)))
+    return result
+
+
+def encode_chromosome(chrom_id, size, starts, ends, values, reductions=ZOOM_REDUCTIONS):
+    """ Encode runs of values (starts, ends, values as arrays) on a chromosome.
+        Runs must be sorted and not overlap. """
+    starts = numpy.asarray(starts, 'int64')
+    ends = numpy.asarray(ends, 'int64')
+    values = numpy.asarray(values, 'float64')
+    keep = ends > starts
+    starts = starts[keep]
+    ends = ends[keep]
+    values = values[keep]
+
+    items = numpy.empty(len(starts), ITEM_DTYPE)
+    items['start'] = starts
+    items['end'] = ends
+    items['value'] = values
+    blocks = _blocks(
+        lambda chunk: struct.pack('<IIIIIBBH',
+            chrom_id, int(chunk['start'][0]), int(chunk['end'][-1]), 0, 0, 1, 0, len(chunk)),
+        items)
+
+    zoom_blocks = [ ]
+    zoom_counts = [ ]
+    for reduction in reductions:
+        records = _zoom_records(chrom_id, size, starts, ends, values, reduction)
+        zoom_blocks.append(_blocks(lambda chunk: '', records))
+        zoom_counts.append(len(records))
+
+    lengths = ends-starts
+    if len(values):
+        summary = (int(lengths.sum()), float(values.min()), float(values.max()),
+                   float((values*lengths).sum()), float((values*values*lengths).sum()))
+    else:
+        summary = (0, 0.0, 0.0, 0.0, 0.0)
+
+    return Section(chrom_id, blocks, zoom_blocks, zoom_counts, summary)
+
+
+def _tree_levels(n_items, block_size):
+    """ Group items into nodes of up to block_size children, up to a single root.
+        Returns levels from leaves to root, each a list of (first, last) child index ranges. """
+    levels = [ ]
+    n = n_items
+    while True:
+        levels.append([ (i, min(i+block_size, n)) for i in xrange(0, max(n,1), block_size) ])
+        if len(levels[-1]) == 1: break
+        n = len(levels[-1])
+    return levels
+
+
+def _write_chrom_tree(f, chrom_names, chrom_sizes):
+    items = sorted(
+        (name, i, size) for i, (name, size) in enumerate(zip(chrom_names, chrom_sizes)) )
+    key_size = max([ len(item[0]) for item in items ] + [ 1 ])
+    block_size = max(1, min(len(items), BLOCK_SIZE))
+    node_size = 4 + block_size*(key_size+8)
+
+    f.write(struct.pack('<IIIIQQ', BPT_MAGIC, block_size, key_size, 8, len(items), 0))
+
+    levels = _tree_levels(len(items), block_size)
+
+    # First item under each node, for keys of parent nodes
+    first_items = [ [ first for first, last in levels[0] ] ]
+    for level in levels[1:]:
+        first_items.append([ first_items[-1][first] for first, last in level ])
+
+    level_offsets = [ None ] * len(levels)
+    offset = f.tell()
+    for k in reversed(xrange(len(levels))):
+        level_offsets[k] = offset
+        offset += len(levels[k]) * node_size
+
+    for k in reversed(xrange(len(levels))):
+        for first, last in levels[k]:
+            f.write(struct.pack('<BBH', 1 if k == 0 else 0, 0, last-first))
+            for i in xrange(first, last):
+                if k == 0:
+                    name, chrom_id, size = items[i]
+                    f.write(name.ljust(key_size, '\0') + struct.pack('<II', chrom_id, size))
+                else:
+                    name = items[first_items[k-1][i]][0]
+                    f.write(name.ljust(key_size, '\0') + struct.pack('<Q', level_offsets[k-1]+i*node_size))
+            f.write('\0' * ((block_size-(last-first))*(key_size+8)))
+
+
+def _write_rtree(f, items, end_file_offset):
+    """ items are [ (chrom_id, start, end, offset, size) ], sorted. """
+    levels = _tree_levels(len(items), BLOCK_SIZE)
+    node_size = lambda k: 4 + BLOCK_SIZE*(32 if k == 0 else 24)
+
+    # Bounds of each node, as (start chrom, start, end chrom, end)
+    bounds = [ [ (items[i][0], items[i][1], items[i][0], items[i][2]) for i in xrange(len(items)) ] ]
+    for level in levels:
+        below = bounds[-1]
+        bounds.append([
+            (below[first][0], below[first][1]) + max(item[2:] for item in below[first:last])
+            for first, last in level if last > first ])
+    total_bounds = bounds[-1][0] if bounds[-1] else (0,0,0,0)
+
+    f.write(struct.pack('<IIQIIIIQII',
+        CIRTREE_MAGIC, BLOCK_SIZE, len(items), *total_bounds + (end_file_offset, 1, 0)))
+
+    level_offsets = [ None ] * len(levels)
+    offset = f.tell()
+    for k in reversed(xrange(len(levels))):
+        level_offsets[k] = offset
+        offset += len(levels[k]) * node_size(k)
+
+    for k in reversed(xrange(len(levels))):
+        for first, last in levels[k]:
+            f.write(struct.pack('<BBH', 1 if k == 0 else 0, 0, last-first))
+            for i in xrange(first, last):
+                if k == 0:
+                    chrom_id, start, end, data_offset, data_size = items[i]
+                    f.write(struct.pack('<IIIIQQ', chrom_id, start, chrom_id, end, data_offset, data_size))
+                else:
+                    f.write(struct.pack('<IIIIQ', *bounds[k][i] + (level_offsets[k-1]+i*node_size(k-1),)))
+            f.write('\0' * ((BLOCK_SIZE-(last-first))*(32 if k == 0 else 24)))
+
+
+def write_bigwig(filename, chrom_names, chrom_sizes, sections, reductions=ZOOM_REDUCTIONS):
+    """ Write a bigWig file from Sections produced by encode_chromosome(),
+        which should be given in chromosome order. sections may be an iterator. """
+    n_zoom = len(reductions)
+
+    with open(filename, 'wb') as f:
+        f.write('\0' * (64 + 24*n_zoom))
+        total_summary_offset = f.tell()
+        f.write('\0' * 40)
+
+        chrom_tree_offset = f.tell()
+        _write_chrom_tree(f, chrom_names, chrom_sizes)
+
+        full_data_offset = f.tell()
+        f.write(struct.pack('<Q', 0))
+
+        index_items = [ ]
+        zoom_items = [ [ ] for i in xrange(n_zoom) ]
+        zoom_counts = [ 0 ] * n_zoom
+        summary = None
+        max_uncompressed = 0
+        for section in sections:
+            for start, end, data, uncompressed_size in section.blocks:
+                index_items.append((section.chrom_id, start, end, f.tell(), len(data)))
+                f.write(data)
+                max_uncompressed = max(max_uncompressed, uncompressed_size)
+            for i in xrange(n_zoom):
+                zoom_items[i].append((section.chrom_id, section.zoom_blocks[i]))
+                zoom_counts[i] += section.zoom_counts[i]
+
+            if section.summary[0]:
+                if summary is None:
+                    summary = section.summary
+                else:
+                    summary = (
+                        summary[0]+section.summary[0],
+                        min(summary[1],section.summary[1]),
+                        max(summary[2],section.summary[2]),
+                        summary[3]+section.summary[3],
+                        summary[4]+section.summary[4])
+
+        full_index_offset = f.tell()
+        _write_rtree(f, index_items, full_index_offset)
+
+        zoom_headers = [ ]
+        for i in xrange(n_zoom):
+            data_offset = f.tell()
+            f.write(struct.pack('<I', zoom_counts[i]))
+            items = [ ]
+            for chrom_id, blocks in zoom_items[i]:
+                for start, end, data, uncompressed_size in blocks:
+                    items.append((chrom_id, start, end, f.tell(), len(data)))
+                    f.write(data)
+                    max_uncompressed = max(max_uncompressed, uncompressed_size)
+            zoom_items[i] = None
+            index_offset = f.tell()
+            _write_rtree(f, items, index_offset)
+            zoom_headers.append(struct.pack('<IIQQ', reductions[i], 0, data_offset, index_offset))
+
+        f.seek(0)
+        f.write(struct.pack('<IHHQQQHHQQIQ',
+            BIGWIG_MAGIC, 4, n_zoom,
+            chrom_tree_offset, full_data_offset, full_index_offset,
+            0, 0, 0, total_summary_offset, max_uncompressed, 0))
+        f.write(''.join(zoom_headers))
+        f.write(struct.pack('<Qdddd', *(summary or (0, 0.0, 0.0, 0.0, 0.0))))
+        f.seek(full_data_offset)
+        f.write(struct.pack('<Q', len(index_items)))
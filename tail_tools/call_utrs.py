@@ -27,12 +27,16 @@ class Call_utrs(config.Action_with_prefix):
         ref = env.load_ref(self.reference_dir)
         analysis = env.load_analysis(self.analysis_dir)
         
+        counts = analysis.peak_table['Count']
         samples = self.samples
         if not samples:
-            samples = analysis.peak_counts['Count'].value_type().keys()
+            samples = counts.columns
+        
+        columns = [ counts.columns.index(sample) for sample in samples ]
+        totals = counts.values[:,columns].sum(axis=1)
         
         def total_count(peak_id):
-            return sum(analysis.peak_counts['Count'][peak_id][sample] for sample in samples)
+            return totals[analysis.peak_table.feature_index[peak_id]]
         
         #for each gene
         #determine a cutoff region
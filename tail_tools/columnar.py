@@ -0,0 +1,308 @@
+"""
+
+Typed, columnar, memory-mappable companion files for grouped CSV tables such as counts.csv.
+
+A companion is written next to the CSV file as <filename>.columnar. Readers use it in
+preference to the CSV file if it was written for the current version of the CSV file
+(same size and modification time), otherwise they fall back to parsing the CSV file.
+
+Layout (all numbers little-endian):
+
+    8 bytes   "TTCOL001"
+    int32     length of JSON header in bytes
+    int32     reserved, 0
+    JSON header: features, comments, source size and mtime, and groups
+    numeric groups, each stored column-major starting at an 8-byte aligned offset
+    relative to the end of the header (also rounded up to 8 bytes)
+
+Numeric groups are "int32" (NA is -2^31, which is also R's NA_integer_) or
+"float64" (NA is NaN). "string" groups are stored in the JSON header.
+
+The R function read_grouped_table() also reads these files.
+
+"""
+
+import os, json, struct, collections
+
+import numpy
+
+from nesoni import io
+
+MAGIC = 'TTCOL001'
+
+NA_INTEGER = -2**31
+
+DTYPES = {
+    'int32' : numpy.dtype('<i4'),
+    'float64' : numpy.dtype('<f8'),
+    }
+
+
+def companion_filename(filename):
+    return filename + '.columnar'
+
+
+def _source_key(filename):
+    stat = os.stat(filename)
+    return { 'size' : stat.st_size, 'mtime' : stat.st_mtime }
+
+
+def _align(n):
+    return (n+7)//8*8
+
+
+def _str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _numeric_matrix(values, type, n_features, n_columns):
+    if isinstance(values, numpy.ndarray):
+        result = numpy.asarray(values)
+        if type == 'int32':
+            result = result.astype(DTYPES[type])
+        else:
+            result = result.astype('float64')
+    else:
+        result = numpy.empty((n_features, n_columns), DTYPES[type])
+        na = NA_INTEGER if type == 'int32' else numpy.nan
+        for i, row in enumerate(values):
+            result[i] = [ na if item is None else item for item in row ]
+    assert result.shape == (n_features, n_columns)
+    return result
+
+
+def write_companion(filename, features, groups, comments=[]):
+    """ Write a companion file for the grouped CSV file filename,
+        which should already have been written.
+
+        groups - [ (name, columns, type, values) ]
+            type is "int32", "float64" or "string".
+            values is a [feature][column] matrix, either a numpy array or
+            a list of rows. None is NA.
+    """
+    features = list(features)
+    n_features = len(features)
+
+    header_groups = [ ]
+    blocks = [ ]
+    offset = 0
+    for name, columns, type, values in groups:
+        columns = list(columns)
+        group = collections.OrderedDict()
+        group['name'] = name
+        group['columns'] = columns
+        group['type'] = type
+        if type == 'string':
+            group['values'] = [ [ ] for item in columns ]
+            for row in values:
+                assert len(row) == len(columns)
+                for j, item in enumerate(row):
+                    group['values'][j].append(item)
+        else:
+            matrix = _numeric_matrix(values, type, n_features, len(columns))
+            group['offset'] = offset
+            blocks.append((offset, matrix))
+            offset = _align(offset + matrix.size * matrix.itemsize)
+        header_groups.append(group)
+
+    header = collections.OrderedDict()
+    header['source'] = _source_key(filename)
+    header['comments'] = list(comments)
+    header['features'] = features
+    header['groups'] = header_groups
+    header_text = json.dumps(header)
+
+    # Write to a temporary file then rename, so concurrent readers never see a partial file
+    out_filename = companion_filename(filename)
+    temp_filename = out_filename + '.%d.tmp' % os.getpid()
+    with open(temp_filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<ii', len(header_text), 0))
+        f.write(header_text)
+        data_start = _align(16 + len(header_text))
+        for block_offset, matrix in blocks:
+            f.write('\0' * (data_start + block_offset - f.tell()))
+            # Column-major
+            f.write(numpy.ascontiguousarray(matrix.T).tobytes())
+    os.rename(temp_filename, out_filename)
+
+
+def is_fresh(filename):
+    """ Is there an up-to-date companion file for filename? """
+    out_filename = companion_filename(filename)
+    if not os.path.exists(out_filename) or not os.path.exists(filename):
+        return False
+    try:
+        header, data_start = _read_header(out_filename)
+    except (IOError, ValueError, AssertionError):
+        return False
+    return header['source'] == _source_key(filename)
+
+
+def _read_header(filename):
+    with open(filename, 'rb') as f:
+        assert f.read(8) == MAGIC, 'Not a columnar file: ' + filename
+        header_length, reserved = struct.unpack('<ii', f.read(8))
+        header = json.loads(f.read(header_length))
+    return header, _align(16 + header_length)
+
+
+class Group(object):
+    """ One group of columns from a grouped table.
+
+        values is a [feature][column] numpy array for "int32" and "float64" groups,
+        or a list of columns (lists of strings) for "string" groups.
+        """
+    def __init__(self, name, columns, type, values):
+        self.name = name
+        self.columns = columns
+        self.type = type
+        self.values = values
+
+    def is_na(self):
+        if self.type == 'int32':
+            return self.values == NA_INTEGER
+        elif self.type == 'float64':
+            return numpy.isnan(self.values)
+        else:
+            return numpy.array([ [ item == 'NA' for item in column ] for column in self.values ]).T
+
+    def row(self, i):
+        """ Row as Python values, NA as None. """
+        if self.type == 'int32':
+            return [ None if item == NA_INTEGER else int(item) for item in self.values[i] ]
+        elif self.type == 'float64':
+            return [ None if item != item else float(item) for item in self.values[i] ]
+        else:
+            return [ column[i] for column in self.values ]
+
+    def text_row(self, i):
+        """ Row as text, as it would appear in a CSV file. """
+        if self.type == 'string':
+            return self.row(i)
+        return [ 'NA' if item is None else repr(item) for item in self.row(i) ]
+
+
+class Table(object):
+    """ A grouped table, as read by read(). """
+    def __init__(self, features, groups, comments):
+        self.features = features
+        self.feature_index = dict( (name,i) for i,name in enumerate(features) )
+        self.groups = collections.OrderedDict( (item.name, item) for item in groups )
+        self.comments = comments
+
+    def __getitem__(self, name):
+        return self.groups[name]
+
+    def __contains__(self, name):
+        return name in self.groups
+
+    def sample_tags(self):
+        result = { }
+        for line in self.comments:
+            if line.startswith('#sampleTags='):
+                parts = line[len('#sampleTags='):].split(',')
+                result[parts[0]] = parts
+        return result
+
+    def grouped_table(self, names=None, text=False):
+        """ Convert to an io.Grouped_table, for code expecting io.read_grouped_table() output.
+
+            If text is true, values are given as strings, otherwise as Python values with NA as None.
+            """
+        if names is None:
+            names = self.groups.keys()
+        result = io.Grouped_table()
+        result.comments = list(self.comments)
+        for name in names:
+            group = self.groups[name]
+            row = group.text_row if text else group.row
+            result[name] = io.named_matrix_type(self.features, group.columns)(
+                [ row(i) for i in xrange(len(self.features)) ])
+        return result
+
+
+def read_companion(filename):
+    """ Read the companion of filename, numeric groups are memory-mapped. """
+    in_filename = companion_filename(filename)
+    header, data_start = _read_header(in_filename)
+
+    features = [ _str(item) for item in header['features'] ]
+    groups = [ ]
+    for item in header['groups']:
+        columns = [ _str(item2) for item2 in item['columns'] ]
+        if item['type'] == 'string':
+            values = [ [ _str(item3) for item3 in item2 ] for item2 in item['values'] ]
+        elif not features or not columns:
+            # Can't memory-map zero bytes
+            values = numpy.zeros((len(features),len(columns)), DTYPES[item['type']])
+        else:
+            values = numpy.memmap(
+                in_filename, dtype=DTYPES[item['type']], mode='r',
+                offset=data_start+item['offset'], shape=(len(columns),len(features))
+                ).T
+        groups.append(Group(_str(item['name']), columns, item['type'], values))
+
+    return Table(features, groups, [ _str(item) for item in header['comments'] ])
+
+
+def _parse_group(name, matrix):
+    columns = matrix.value_type().keys()
+    rows = [ row.values() for row in matrix.values() ]
+
+    type = 'int32'
+    for row in rows:
+        for item in row:
+            if item == 'NA': continue
+            if type == 'int32':
+                try:
+                    int(item)
+                    continue
+                except ValueError:
+                    type = 'float64'
+            try:
+                float(item)
+            except ValueError:
+                type = 'string'
+                break
+        if type == 'string': break
+
+    if type == 'string':
+        values = [ [ row[j] for row in rows ] for j in xrange(len(columns)) ]
+    else:
+        convert = int if type == 'int32' else float
+        values = _numeric_matrix(
+            [ [ None if item == 'NA' else convert(item) for item in row ] for row in rows ],
+            type, len(rows), len(columns))
+    return Group(name, columns, type, values)
+
+
+def read(filename):
+    """ Read a grouped table, from its companion file if it is up to date,
+        otherwise from the CSV file.
+
+        In the latter case, an attempt is made to create the companion file.
+        """
+    if is_fresh(filename):
+        return read_companion(filename)
+
+    data = io.read_grouped_table(filename)
+    features = [ ]
+    groups = [ ]
+    for name, matrix in data.items():
+        features = matrix.keys()
+        groups.append(_parse_group(name, matrix))
+    result = Table(features, groups, list(data.comments))
+
+    try:
+        write_companion(filename, features,
+            [ (item.name, item.columns, item.type,
+               item.values if item.type != 'string' else [ item.row(i) for i in xrange(len(features)) ])
+              for item in groups ],
+            result.comments)
+    except (IOError, OSError):
+        pass
+
+    return result
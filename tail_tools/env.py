@@ -7,9 +7,11 @@ Added to as necessity and whim dictates, don't expect any kind of sense.
 """
 
 
-import mmap, collections
+import os, mmap, collections
+import cPickle as pickle
 from os.path import join
 from nesoni import io, annotation, reference_directory, span_index
+from . import columnar
 
 COLORS = {
     'A':(0,1,0),
@@ -43,6 +45,73 @@ def memo_property(func):
     return property(outer)
 
 
+# Bump this if the objects being cached change
+CACHE_VERSION = 1
+
+def _cache_key(filenames, extra):
+    key = [ CACHE_VERSION, extra ]
+    for filename in filenames:
+        stat = os.stat(filename)
+        key.append((os.path.abspath(filename), stat.st_mtime, stat.st_size))
+    return key
+
+def cached(filenames, name, func, extra=None):
+    """ Return func(), using a cache on disk if none of filenames have 
+        changed since it was written. The cache is kept in a directory 
+        "tail-tools-cache" alongside filenames[0].
+        
+        extra - further value the cache must match, such as a digest of the
+            input. A cache with a different extra value is replaced.
+        
+        Caches are written to a temporary file then renamed, so concurrent
+        processes can share them. If the cache can't be written (eg read-only
+        directory, or a result that can't be pickled) func() is simply 
+        called each time.
+        """
+    key = _cache_key(filenames, extra)
+    cache_dir = join(os.path.dirname(filenames[0]), 'tail-tools-cache')
+    cache_filename = join(cache_dir, os.path.basename(filenames[0]) + '.' + name + '.pickle')
+    
+    try:
+        with open(cache_filename,'rb') as f:
+            cache_key, result = pickle.load(f)
+        if cache_key == key:
+            return result
+    except (IOError, EOFError, ValueError, TypeError, AttributeError, ImportError, pickle.UnpicklingError):
+        # Missing, partial or out of date
+        pass
+    
+    result = func()
+    
+    temp_filename = cache_filename + '.%d.tmp' % os.getpid()
+    try:
+        if not os.path.exists(cache_dir):
+            os.mkdir(cache_dir)
+        with open(temp_filename,'wb') as f:
+            pickle.dump((key, result), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, cache_filename)
+    except (IOError, OSError, TypeError, RuntimeError, pickle.PicklingError):
+        pass
+    finally:
+        if os.path.exists(temp_filename):
+            try:
+                os.unlink(temp_filename)
+            except OSError:
+                pass
+    
+    return result
+
+def cached_property(*filenames):
+    """ memo_property that is also cached on disk (see cached()). 
+        filenames are the files the value depends on, relative to self.dirname. """
+    def decorator(func):
+        def outer(self):
+            return cached([ join(self.dirname,item) for item in filenames ], func.__name__, lambda: func(self))
+        outer.__name__ = func.__name__
+        return memo_property(outer)
+    return decorator
+
+
 class Reference(object):
     def __init__(self, dirname):
         self.dirname = dirname
@@ -58,23 +127,34 @@ class Reference(object):
                 seqs[name] = mmap.mmap(f.fileno(), 0, access=mmap.PROT_READ)
         return seqs
 
+    # Features and their index are cached together, so the index refers to the same objects
+    @cached_property('reference.gff')
+    def genes_and_index(self):
+        genes = index(join(self.dirname,'reference.gff'), 'gene')
+        return genes, span_index.index_annotations(genes.values())
+
     @memo_property
     def genes(self):
-        return index(join(self.dirname,'reference.gff'), 'gene')
+        return self.genes_and_index[0]
     
     @memo_property
     def gene_index(self):
-        return span_index.index_annotations(self.genes.values())
+        return self.genes_and_index[1]
+
+    @cached_property('utr.gff')
+    def utrs_and_index(self):
+        utrs = index(join(self.dirname,'utr.gff'), name=lambda item: item.attr['Parent'])
+        return utrs, span_index.index_annotations(utrs.values())
 
     @memo_property
     def utrs(self):
-        return index(join(self.dirname,'utr.gff'), name=lambda item: item.attr['Parent'])
+        return self.utrs_and_index[0]
     
     @memo_property
     def utr_index(self):
-        return span_index.index_annotations(self.utrs.values())
+        return self.utrs_and_index[1]
 
-    @memo_property
+    @cached_property('reference.gff')
     def coding_regions(self):
         coding_regions = { }
         annotations = list(annotation.read_annotations(join(self.dirname,'reference.gff')))
@@ -119,45 +199,51 @@ class Analysis(object):
     def __init__(self, dirname):
         self.dirname = dirname
 
-    @memo_property
-    def peaks(self):
-        return index(join(self.dirname,'peaks','relation-child.gff'),
+    @cached_property(join('peaks','relation-child.gff'))
+    def peaks_and_index(self):
+        peaks = index(join(self.dirname,'peaks','relation-child.gff'),
             modify=lambda item: item.three_prime())
+        return peaks, span_index.index_annotations(peaks.itervalues())
 
     @memo_property
+    def peaks(self):
+        return self.peaks_and_index[0]
+
+    @cached_property(join('peaks','relation-child.gff'))
     def peaks_asis(self):
         return index(join(self.dirname,'peaks','relation-child.gff'))
 
     @memo_property
     def peak_index(self):
-        return span_index.index_annotations(self.peaks.itervalues())
+        return self.peaks_and_index[1]
 
     @memo_property
-    def peak_counts(self):
-        return io.read_grouped_table(
-            join(self.dirname,'expression','peakwise','counts.csv'),
-            [ ('Count',int), ('Tail_count',int), 
-              ('Tail', float_or_none), ('Proportion', float_or_none) ],
-            )
+    def peak_table(self):
+        return columnar.read(join(self.dirname,'expression','peakwise','counts.csv'))
 
     @memo_property
+    def peak_counts(self):
+        return self.peak_table.grouped_table(
+            [ 'Count', 'Tail_count', 'Tail', 'Proportion' ])
+
+    @cached_property(join('peaks','primary-peak-peaks.gff'))
     def primary_peaks(self):
         return index(join(self.dirname,'peaks','primary-peak-peaks.gff'),
             modify=lambda item: item.three_prime())
 
-    @memo_property
+    @cached_property(join('peaks','primary-peak-peaks.gff'))
     def primary_peaks_asis(self):
         return index(join(self.dirname,'peaks','primary-peak-peaks.gff'))
 
-    @memo_property
+    @cached_property(join('peaks','primary-peak-utrs.gff'))
     def primary_utrs(self):
         return index(join(self.dirname,'peaks','primary-peak-utrs.gff'))
 
-    @memo_property
+    @cached_property(join('peaks','primary-peak-utrs.gff'))
     def primary_utrs_by_peak(self):
         return index(join(self.dirname,'peaks','primary-peak-utrs.gff'), name=lambda item:item.attr["Peak"])
         
-    @memo_property
+    @cached_property(join('peaks','primary-peak-genes.gff'))
     def primary_genes(self):
         return index(join(self.dirname,'peaks','primary-peak-genes.gff'))
 
@@ -203,7 +289,20 @@ def kmers(k):
         for base in ['A','C','G','T']
         ]
           
-def kmer_pile(ref,feat,k,start,end):
+def _base_codes(seqs, length):
+    """ Sequences as a [sequence][position] array of 2-bit base codes 
+        (A=0, C=1, G=2, T=3, in the order used by kmers()).
+        Anything else, such as N, is -1. Sequences are padded to length with -1. """
+    import numpy
+    lookup = numpy.empty(256, 'int32')
+    lookup.fill(-1)
+    for i, base in enumerate('ACGT'):
+        lookup[ord(base)] = i
+        lookup[ord(base.lower())] = i
+    text = ''.join( seq[:length].ljust(length,'N') for seq in seqs )
+    return lookup[numpy.frombuffer(text,'uint8')].reshape(len(seqs), length)
+
+def kmer_pile(ref,feat,k,start,end, batch_size=1000):
     import numpy
     result = Kmer_pile()
     result.k = k
@@ -214,13 +313,26 @@ def kmer_pile(ref,feat,k,start,end):
     
     result.kmers = kmers(k)
     result.kmer_index = dict( (item,i) for i,item in enumerate(result.kmers) )
-    result.piles = numpy.zeros((len(result.kmers),end-start), 'int32')
-    for item in feat:
-        seq = item.three_prime().shifted(start,end+k).get_seq(ref.seqs).upper()
-        for i in xrange(end-start):
-            kmer = seq[i:i+k]
-            if kmer in result.kmer_index:
-               result.piles[result.kmer_index[kmer]][i] += 1
+    
+    # k-mer codes as rolling integers, for batches of features at once
+    n = end-start
+    counts = numpy.zeros(len(result.kmers)*n, 'int64')
+    for i in xrange(0, len(feat), batch_size):
+        bases = _base_codes(
+            [ item.three_prime().shifted(start,end+k).get_seq(ref.seqs) for item in feat[i:i+batch_size] ],
+            n+k)
+        codes = numpy.zeros((len(bases),n), 'int64')
+        valid = numpy.ones((len(bases),n), bool)
+        for j in xrange(k):
+            window = bases[:,j:j+n]
+            codes = codes*4 + window
+            valid &= window >= 0
+        
+        # Index into flattened [kmer][position] piles
+        counts += numpy.bincount(
+            (codes * n + numpy.arange(n))[valid], minlength=len(counts))
+    
+    result.piles = counts.reshape((len(result.kmers),n)).astype('int32')
     return result
 
 def kmer_pile_excess(pile, background):
@@ -256,32 +368,48 @@ def kmer_pile_add(pile1, pile2):
 #    for name, pile in p.items():
 #        pylab.plot(pile)
 
-def stack_kmer_pile(p, border=(0,0,0), border_thickness=1.5, figsize=(20.0,6.0), position=[0.05,0.05,0.85,0.93]):
-    import pylab
+def stack_kmer_pile(p, border=(0,0,0), border_thickness=1.5, figsize=(20.0,6.0), position=[0.05,0.05,0.85,0.93], collection=True):
+    """ Plot a k-mer pile as stacked patches.
+    
+        Patches are placed greedily, each time choosing the patch that leaves 
+        the lowest top edge above the current stack. With collection=True,
+        patches are added as a single PatchCollection, which is much faster
+        to draw than many separate patches.
+        """
+    import pylab, heapq, numpy
     from matplotlib.patches import Rectangle
+    from matplotlib.collections import PatchCollection
     pylab.figure(figsize=figsize)
     
     pylab.axvline(alpha=0.5, color='black')
     
     k = p.k
     
-    items = [ ]
-    for i in xrange(len(p.kmers)):
-        for j in xrange(p.end-p.start):
-            if p.piles[i][j] >= 0.01*p.n:
-                items.append((p.piles[i][j], p.kmers[i], j))
-    
     heights = [ 0 ] * (p.end-p.start)
     
-    while items:
-        i = min(xrange(len(items)),
-            key=lambda i: max(heights[items[i][2]:items[i][2]+k])  -items[i][0])
-        height, kmer, i = items.pop(i)
+    def key(height, i):
+        return max(heights[i:i+k]) - height
+    
+    # Heights only increase, so a key in the heap is never more than the current key.
+    # If the smallest key in the heap is current, it is the smallest overall.
+    heap = [ ]
+    for number, (i, j) in enumerate(zip(*numpy.nonzero(p.piles >= 0.01*p.n))):
+        height = p.piles[i][j]
+        heap.append((key(height,j), number, height, p.kmers[i], j))
+    heapq.heapify(heap)
     
+    patches = [ ]
+    while heap:
+        old_key, number, height, kmer, i = heapq.heappop(heap)
+        new_key = key(height, i)
+        if new_key != old_key:
+            heapq.heappush(heap, (new_key, number, height, kmer, i))
+            continue
+        
         offset = max(heights[i:i+k])
         heights[i:i+k] = [ offset+height ] * k
         for j in xrange(k):
-            pylab.gca().add_patch(Rectangle((p.start-0.5+i+j,offset),1,height,
+            patches.append(Rectangle((p.start-0.5+i+j,offset),1,height,
                 linewidth=border_thickness/15,
                 edgecolor = border,
                 facecolor = COLORS[kmer[j]]))
@@ -289,11 +417,17 @@ def stack_kmer_pile(p, border=(0,0,0), border_thickness=1.5, figsize=(20.0,6.0),
             #    pylab.annotate(kmer[j],(p.start-0.5+i+j+0.5,offset+height*0.5), size=8, ha='center', va='center')
         #if height > 0.05*p.n:
         #    pylab.annotate('%.0f%%' % (height*100.0/p.n),(p.start-0.5+i+k,offset), size=8,ha='right',va='bottom')
-        pylab.gca().add_patch(Rectangle((
+        patches.append(Rectangle((
             p.start-0.5+i,offset),k,height, 
             fill=False,
             edgecolor=border,
             linewidth=border_thickness))
+    
+    if collection:
+        pylab.gca().add_collection(PatchCollection(patches, match_original=True))
+    else:
+        for patch in patches:
+            pylab.gca().add_patch(patch)
 
     for i,c in enumerate('ACGT'):
         pylab.figtext(0.95,0.9-i*0.1, c, size=15.0, backgroundcolor=COLORS[c], ha='center')
@@ -0,0 +1,131 @@
+"""
+
+Lazy access to a FASTA file through its samtools faidx index (<filename>.fai).
+
+Sequence lengths come from the index. Sequence is only read when it is
+asked for, from a memory-mapping of the FASTA file, so this is cheap
+even for mammalian genomes.
+
+"""
+
+import os, mmap, subprocess, collections
+
+
+Index_entry = collections.namedtuple('Index_entry', 'length offset line_bases line_width')
+
+
+def _read_index(filename):
+    """ { name : Index_entry }, from <filename>.fai.
+    
+        The index is created with "samtools faidx" if it is missing or out of date. 
+        If it can't be written (eg a shared, read-only reference directory), 
+        the index is instead calculated here and not saved. 
+        """
+    index_filename = filename + '.fai'
+    if not os.path.exists(index_filename) or \
+           os.path.getmtime(index_filename) < os.path.getmtime(filename):
+        try:
+            if not os.access(os.path.dirname(os.path.abspath(index_filename)), os.W_OK):
+                raise OSError('Can not write '+index_filename)
+            subprocess.check_call(['samtools', 'faidx', filename])
+        except (OSError, subprocess.CalledProcessError):
+            return _scan_index(filename)
+    
+    index = collections.OrderedDict()
+    with open(index_filename,'rb') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            index[parts[0]] = Index_entry(*[ int(item) for item in parts[1:5] ])
+    return index
+
+
+def _scan_index(filename):
+    """ Same index as "samtools faidx" would produce, by reading through the file. """
+    index = collections.OrderedDict()
+    name = None
+    position = 0
+    with open(filename,'rb') as f:
+        for line in f:
+            if line.startswith('>'):
+                if name is not None:
+                    index[name] = Index_entry(length, offset, line_bases, line_width)
+                name = line[1:].split()[0]
+                length = 0
+                offset = position + len(line)
+                line_bases = 0
+                line_width = 0
+            elif name is not None:
+                bases = len(line.rstrip('\r\n'))
+                if not line_width:
+                    line_bases = bases
+                    line_width = len(line)
+                length += bases
+            position += len(line)
+    if name is not None:
+        index[name] = Index_entry(length, offset, line_bases, line_width)
+    return index
+
+
+class Sequence(object):
+    """ A sequence in an Indexed_fasta. Supports len() and slicing. """
+    def __init__(self, fasta, name):
+        self.fasta = fasta
+        self.name = name
+
+    def __len__(self):
+        return self.fasta.index[self.name].length
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, end, step = item.indices(len(self))
+            assert step == 1, 'Step not supported.'
+            return self.fasta.fetch(self.name, start, end)
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError(item)
+        return self.fasta.fetch(self.name, item, item+1)
+
+
+class Indexed_fasta(object):
+    """ Read-only mapping from sequence name to Sequence.
+
+        The index is created with "samtools faidx" if it is missing or out of date
+        (see _read_index).
+        """
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = _read_index(filename)
+        self._data = None
+
+    def lengths(self):
+        return [ (name, entry.length) for name, entry in self.index.iteritems() ]
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        if name not in self.index:
+            raise KeyError(name)
+        return Sequence(self, name)
+
+    def _position(self, entry, pos):
+        return entry.offset + (pos // entry.line_bases) * entry.line_width + pos % entry.line_bases
+
+    def fetch(self, name, start, end):
+        """ Sequence from 0-based start to end, clipped to the sequence. """
+        entry = self.index[name]
+        start = max(0, start)
+        end = min(entry.length, end)
+        if end <= start:
+            return ''
+
+        if self._data is None:
+            with open(self.filename,'rb') as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        raw = self._data[self._position(entry,start):self._position(entry,end-1)+1]
+        return raw.replace('\n','').replace('\r','')
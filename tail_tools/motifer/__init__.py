@@ -7,11 +7,15 @@ from .recognizers import (
     Recognize_regex, 
     Recognize_pwm, 
     Bad_pwm_exception,
+    encode,
+    decode,
     kmers,
+    kmer_number,
     kmer_recognizers
     )
 
 from .pilers import (
+    Regions,
     Piler,
     Anchored_piler,
     Stretched_piler,
@@ -2,10 +2,34 @@
 from __future__ import division
 
 from tail_tools import env
+from .recognizers import encode
 import numpy, re
 from numpy import random
 
 
+class Regions(object):
+    """ Sequences of some features, each extended at the 3' end by extension bases,
+        upper-cased, concatenated and encoded with encode().
+        
+        offsets - start of each feature's sequence in text and codes
+        """
+    def __init__(self, seqs, features, extension):
+        texts = [ item.shifted(0,extension).get_seq(seqs).upper() for item in features ]
+        self.extension = extension
+        self.lengths = numpy.array([ len(item) for item in texts ], 'int64')
+        self.offsets = numpy.cumsum(self.lengths) - self.lengths
+        self.text = ''.join(texts)
+        self.codes = encode(self.text)
+    
+    def count(self, recognizer):
+        """ Number of matches lying wholly within each feature (not the extension). """
+        match = numpy.zeros(len(self.codes)+1, 'int64')
+        match[1:] = recognizer.scan(self.text, self.codes) != 0
+        cumulative = numpy.cumsum(match)
+        ends = self.offsets + numpy.clip(self.lengths-self.extension-recognizer.length+1, 0, self.lengths)
+        return cumulative[ends] - cumulative[self.offsets]
+
+
 
 class Piler(object):
     """
@@ -19,26 +43,94 @@ class Piler(object):
         self.n = n
         self.x = numpy.arange(n) + 0.5
         self.ticks = [ ]
+        self._bin_matrix = None
+        self._regions = { }
 
     
-    def pile(self, seqs, recognizer, weights=None):
+    def bin_matrix(self):
+        """ Sparse matrix taking matches at positions within fetched regions to piles,
+            in coordinate form: (bin, fetcher, position, coefficient) arrays. 
+            Weights for each fetcher still need to be applied. """
+        if self._bin_matrix is None:
+            parts = [ ]
+            for number, (fetcher, bins) in enumerate(self.fetchers):
+                bins = numpy.asarray(bins, 'int64')
+                a = bins[:-1]
+                b = numpy.maximum(a+1, bins[1:])
+                sizes = b-a
+                starts = numpy.cumsum(sizes) - sizes
+                parts.append((
+                    numpy.repeat(numpy.arange(len(a)), sizes),
+                    numpy.repeat(numpy.array([number]), sizes.sum()),
+                    numpy.repeat(a-starts, sizes) + numpy.arange(sizes.sum()),
+                    numpy.repeat(1.0/sizes, sizes),
+                    ))
+            self._bin_matrix = tuple( 
+                numpy.concatenate([ item[i] for item in parts ] or [ numpy.zeros(0,'int64') ]) 
+                for i in xrange(4) )
+        return self._bin_matrix
+
+    
+    def regions(self, seqs, length=1):
+        """ Regions for the fetchers, extended enough for motifs up to length.
+            These are cached, so sequences are only fetched once for all motifs. """
+        key = id(seqs)
+        if key not in self._regions or self._regions[key][1].extension < length:
+            # Keep seqs, so the id is not reused
+            self._regions[key] = (seqs, Regions(seqs, [ fetcher for fetcher, bins in self.fetchers ], max(1,length)))
+        return self._regions[key][1]
+
+    
+    def _weights(self, weights):
         if weights is None:
             weights = [ 1.0/len(self.fetchers) ]*len(self.fetchers)
+        return numpy.asarray(weights, 'float64')
+
     
-        pile = numpy.zeros(self.n)
+    def bin(self, regions, match, weights=None):
+        """ Gather matches, as from recognizer.scan() of regions, into bins. """
+        weights = self._weights(weights)
+        bin_number, fetcher, position, coefficient = self.bin_matrix()
+        return numpy.bincount(
+            bin_number, 
+            weights=match[regions.offsets[fetcher]+position] * coefficient * weights[fetcher], 
+            minlength=self.n)
+
+    
+    def pile(self, seqs, recognizer, weights=None):
+        # Scan all regions at once, then gather matches into bins
+        regions = self.regions(seqs, recognizer.length)
+        return self.bin(regions, recognizer.scan(regions.text, regions.codes), weights)
+
+
+    def pile_kmers(self, seqs, k, weights=None):
+        """ Piles for all k-mers at once, in one pass over the regions.
+            Returns a [k-mer][bin] matrix, k-mers in the order of kmers("ACGT",k).
+            Row i is the same as pile() with Recognize_string(kmers("ACGT",k)[i]). """
+        return self.bin_kmers(self.regions(seqs, k), k, weights)
+
+    
+    def bin_kmers(self, regions, k, weights=None):
+        """ pile_kmers() of the given regions. """
+        weights = self._weights(weights)
         
-        for weight, (fetcher, bins) in zip(weights,self.fetchers):
-            if not weight: continue
-            
-            seq = fetcher.shifted(0,recognizer.length).get_seq(seqs).upper()
-            
-            for i in xrange(len(bins)-1):
-                a = bins[i]
-                b = max(a+1,bins[i+1])
-                for j in xrange(a,b):
-                    pile[i] += float(recognizer(seq[j:j+recognizer.length])) * (weight/(b-a))
+        # k-mer codes as rolling integers, excluding any containing a non-ACGT base
+        n = len(regions.codes)-k+1
+        codes = numpy.zeros(n, 'int64')
+        valid = numpy.ones(n, bool)
+        for i in xrange(k):
+            window = regions.codes[i:i+n]
+            codes = codes*4 + window
+            valid &= window < 4
         
-        return pile
+        bin_number, fetcher, position, coefficient = self.bin_matrix()
+        index = regions.offsets[fetcher]+position
+        keep = valid[index]
+        return numpy.bincount(
+            codes[index[keep]]*self.n + bin_number[keep],
+            weights=(coefficient * weights[fetcher])[keep],
+            minlength=4**k*self.n
+            ).reshape((4**k, self.n))
 
 
     def pile_features(self, index, weights=None):
@@ -1,6 +1,26 @@
 
 from __future__ import division
 
+import numpy
+
+
+BASES = "ACGT"
+
+# Base codes, as used by encode()
+_BASE_CODES = numpy.empty(256, 'int8')
+_BASE_CODES.fill(len(BASES))
+for _i, _base in enumerate(BASES):
+    _BASE_CODES[ord(_base)] = _i
+
+def encode(text):
+    """ Upper case sequence as an array of base codes, A=0, C=1, G=2, T=3, anything else 4. """
+    return _BASE_CODES[numpy.frombuffer(text,'uint8')]
+
+
+def decode(codes):
+    """ Inverse of encode(), with anything other than ACGT becoming N. """
+    return numpy.frombuffer(BASES+"N",'uint8')[codes].tobytes()
+
 
 def kmers(letters, n):
     if not n: return [""]
@@ -14,21 +34,48 @@ def kmers(letters, n):
 
 
 class Recognizer(object):
+    """ Subclasses provide .length and __call__(string), and may 
+        override scan() with something faster. """
+    
+    def scan(self, text, codes):
+        """ self(text[i:i+self.length]) for each position i in text, as an array of floats.
+            Positions where the motif would run off the end of text are 0.
+            codes is text encoded with encode(). """
+        result = numpy.zeros(len(text))
+        for i in xrange(0,min(len(text),len(text)-self.length+1)):
+            result[i] = float(self(text[i:i+self.length]))
+        return result
+    
     def count(self, seq):
-        n = 0
-        for i in xrange(0,len(seq)-self.length+1):
-            if self(seq[i:i+self.length]):
-                n += 1
-        return n
+        return int(numpy.count_nonzero(self.scan(seq, encode(seq))))
 
 
 class Recognize_string(Recognizer):
     def __init__(self, string):
         self.string = string
         self.length = len(string)
+        
+        # Plain k-mers can be piled all at once, see Piler.pile_kmers()
+        if string and all( char in BASES for char in string ):
+            self.kmer = string
+        else:
+            self.kmer = None
     
     def __call__(self, string):
         return string == self.string
+    
+    def scan(self, text, codes):
+        if self.kmer is None:
+            return Recognizer.scan(self, text, codes)
+        
+        result = numpy.zeros(len(codes))
+        n = len(codes)-self.length+1
+        if n > 0:
+            match = numpy.ones(n, bool)
+            for i, char in enumerate(self.string):
+                match &= codes[i:i+n] == BASES.index(char)
+            result[:n] = match
+        return result
 
 
 class Recognize_regex(Recognizer):
@@ -36,9 +83,33 @@ class Recognize_regex(Recognizer):
         import re
         self.length = length
         self.regex = re.compile(pattern)
+        
+        # Overlapping matches at every position, in one pass
+        self.finder = re.compile("(?=(%s))" % pattern)
+        
+        # Whether the pattern looks at where the string ends, 
+        # in which case matching within the whole text is not the same as matching windows
+        self.windowed = any( item in pattern.replace("[^","[") 
+            for item in ("^","$","\\b","\\B","\\A","\\Z","(?=","(?!","(?<") )
     
     def __call__(self, string):
         return self.regex.match(string) is not None
+    
+    def scan(self, text, codes):
+        if self.windowed:
+            return Recognizer.scan(self, text, codes)
+        
+        result = numpy.zeros(len(text))
+        n = len(text)-self.length+1
+        for match in self.finder.finditer(text):
+            i = match.start()
+            if i >= n: break
+            if match.end(1) <= i+self.length:
+                result[i] = 1.0
+            elif self.regex.match(text, i, i+self.length):
+                # The match in the whole text overran the window, but a shorter one might not 
+                result[i] = 1.0
+        return result
 
 
 
@@ -71,7 +142,30 @@ class Recognize_pwm(Recognizer):
         
         #return 2.0 ** score
         return score >= self.cutoff
-
+    
+    def scan(self, text, codes):
+        # Bases other than ACGT never match
+        table = numpy.empty((self.length,len(BASES)+1))
+        table[:,:len(BASES)] = self.score_matrix
+        table[:,len(BASES)] = -numpy.inf
+        
+        result = numpy.zeros(len(codes))
+        n = len(codes)-self.length+1
+        if n > 0:
+            score = numpy.zeros(n)
+            for i in xrange(self.length):
+                score += table[i][codes[i:i+n]]
+            result[:n] = score >= self.cutoff
+        return result
+
+
+
+def kmer_number(kmer):
+    """ Position of kmer in kmers("ACGT", len(kmer)). """
+    result = 0
+    for char in kmer:
+        result = result*4 + BASES.index(char)
+    return result
 
 
 def kmer_recognizers(upto=3):
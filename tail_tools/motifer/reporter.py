@@ -2,9 +2,9 @@
 from __future__ import division
 
 from .. import env
-from . import pilers, rmonkey
+from . import pilers, recognizers, rmonkey
 
-import os, numpy, numpy.random, random, textwrap
+import os, bisect, numpy, numpy.random, textwrap, hashlib, multiprocessing
 from os.path import join
 
 def require_dir(dirname):
@@ -27,50 +27,115 @@ def require_dir(dirname):
 #    return result
 
 
-def shuffle(string,n,sd):
-    if len(string) <= n: 
-        return string
+def shuffle_codes(codes,n,sd,random_state):
+    """ Local shuffle of an array of base codes (see recognizers.encode), 
+        preserving n-mer counts. Bases are moved a random amount, 
+        (close to) normally distributed with standard deviation sd.
+        Randomness is from random_state. """
+    length = len(codes)
+    if length <= n:
+        return codes.copy()
     
     n1 = n-1
+    n_contexts = 5**n1
     
-    string = string
+    # Context of each position i >= n1, as an integer
+    context_of = numpy.zeros(length-n1, 'int64')
+    for i in xrange(n1):
+        context_of = context_of*5 + codes[i:i+length-n1]
     
-    bins = { }
-    for i in xrange(n1,len(string)):
-        context = string[i-n1:i]
-        if context not in bins: bins[context] = [ ]
-        bins[context].append(i)
+    # Positions in each context bin, in the order they will be taken
+    candidates = numpy.arange(n1,length)
+    order = numpy.lexsort((candidates - random_state.normal(0.0,sd,len(candidates)), context_of))
+    bins = candidates[order]
+    bin_start = numpy.searchsorted(context_of[order], numpy.arange(n_contexts+1))
+    next_item = bin_start[:-1].tolist()
+    bin_end = bin_start[1:].tolist()
+    bins = bins.tolist()
     
-    for item in bins.itervalues():
-        item.sort(key=lambda i: -i+random.normalvariate(0.0,sd))
-    
-    context = string[:n1]
+    context = 0
+    for i in xrange(n1):
+        context = context*5 + codes[i]
+    codes_list = codes.tolist()
     positions = range(n1)
-    resets = set()
-    for i in xrange(n1,len(string)):
-        while context not in bins or not bins[context]:
-            resets.add(i)
-            context = random.choice(list(bins))
+    for i in xrange(n1,length):
+        if next_item[context] >= bin_end[context]:
+            # Reset to a random context with positions remaining
+            remaining = [ item for item in xrange(n_contexts) if next_item[item] < bin_end[item] ]
+            context = remaining[random_state.randint(len(remaining))]
         
-        j = bins[context].pop()
+        j = bins[next_item[context]]
+        next_item[context] += 1
         positions.append(j)
-        context = (context+string[j])[1:]
+        context = (context*5 + codes_list[j]) % n_contexts
+    
+    return codes[positions]
 
-    #print "Resets at", sorted(resets), "of", len(string)
-    offsets = positions - numpy.arange(len(positions))
-    #print numpy.sqrt(numpy.mean(offsets*offsets)), "sd, aiming for", sd
 
-    return "".join( string[i] for i in positions )
+SHUFFLE_SD = 10.0
 
+# Flank either side of shuffled regions, a few SHUFFLE_SD
+SHUFFLE_FLANK = 50
 
-def shuffle_all(seqs,n,sd):
-    """ Local-shuffle a dictionary of sequences """
+def merge_intervals(features, flank):
+    """ Forward strand intervals covering features plus flank bases either side,
+        with overlapping intervals merged. { seqid : [ (start, end) ] } """
+    spans = { }
+    for item in features:
+        spans.setdefault(item.seqid, [ ]).append((item.start-flank, item.end+flank))
+    
     result = { }
-    for name in seqs:
-        result[name] = shuffle(seqs[name],n,sd)
+    for name, items in spans.iteritems():
+        merged = [ ]
+        for start, end in sorted(items):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start,end])
+        result[name] = [ tuple(item) for item in merged ]
     return result
 
 
+def shuffle_texts(texts,n,sd,seed=1):
+    """ Local-shuffle a list of sequences """
+    random_state = numpy.random.RandomState(seed)
+    return [ 
+        recognizers.decode(shuffle_codes(recognizers.encode(item),n,sd,random_state)) 
+        for item in texts ]
+
+
+class Shuffled_sequence(object):
+    """ Sequence given only within some intervals, N elsewhere.
+        Supports len() and slicing, as used by Annotation.get_seq(). """
+    def __init__(self, length, starts, texts):
+        self.length = length
+        self.starts = starts
+        self.texts = texts
+    
+    def __len__(self):
+        return self.length
+    
+    def __getitem__(self, item):
+        start, end, step = item.indices(self.length)
+        assert step == 1, 'Step not supported.'
+        
+        result = [ ]
+        pos = start
+        i = max(0, bisect.bisect_right(self.starts, start)-1)
+        while pos < end and i < len(self.starts):
+            a = self.starts[i]
+            b = min(end, a+len(self.texts[i]))
+            if a > pos:
+                result.append('N' * (min(a,end)-pos))
+                pos = min(a,end)
+            if pos < b:
+                result.append(self.texts[i][pos-a:b-a])
+                pos = b
+            i += 1
+        result.append('N' * (end-pos))
+        return ''.join(result)
+
+
 def html_header(f, title, show_title=True):
     f.write(
         "<!doctype html>\n"+
@@ -115,12 +180,16 @@ class Context(object):
                 weights[ self.gene_number[gene] ] = 1.0/len(genes)
             self.set_weights.append((name, weights))
     
+        self.kmer_piles = { }
+        self.shuffles = { }
+        
         self.upstrands = [ None ]*self.n_genes
         self.coding_regions = [ None ]*self.n_genes
         self.utrs = [ None ]*self.n_genes
         self.downstrands = [ None ]*self.n_genes
         
-        utr_index = env.index(utr_filename, name=lambda item: item.attr["Parent"])
+        utr_index = env.cached([ utr_filename ], 'utrs-by-parent', 
+            lambda: env.index(utr_filename, name=lambda item: item.attr["Parent"]))
         
         for i, name in enumerate(self.genes):
             self.coding_regions[i] = self.ref.coding_regions[name]
@@ -184,18 +253,106 @@ class Context(object):
             #  [ item.five_prime().shifted(-50,0) for item in self.codings ]),
             ]
     
+    def kmer_pile(self, piler, shuffle, set_number, kmer):
+        """ Pile of a k-mer, from piles of all k-mers of that length computed in one pass. """
+        key = (id(piler), shuffle, set_number, len(kmer))
+        if key not in self.kmer_piles:
+            self.kmer_piles[key] = piler.bin_kmers(
+                self.regions(piler, len(kmer), shuffle), len(kmer), self.set_weights[set_number][1])
+        return self.kmer_piles[key][recognizers.kmer_number(kmer)]
+    
+    def lines(self, length):
+        """ Sequences to plot motifs of a given length in: 
+            [ (label suffix, line width, line style, shuffle k or None for actual sequence) ] """
+        lines = [("",3.0,"-",None)]
+        if length > 2:
+            lines.append((", shuffle sd=10 k=2",1.0,"--",2))
+        if length > 1:
+            lines.append((", shuffle sd=10 k=1",1.0,":",1))
+        return lines
+    
+    def regions(self, piler, length, shuffle=None):
+        """ Regions of a piler, extended enough for motifs up to length.
+        
+            If shuffle is given, the regions are from shuffled_seqs(). 
+            """
+        if shuffle is None:
+            return piler.regions(self.ref.seqs, length)
+        return piler.regions(self.shuffled_seqs(length, shuffle), length)
+    
+    def shuffled_seqs(self, length, shuffle):
+        """ Sequences locally shuffled preserving shuffle-mers (sd=10).
+            
+            Only the regions of the pilers are shuffled, not the whole genome, 
+            but with flanks either side so that bases near the ends of regions 
+            can still be exchanged with bases outside them. Overlapping regions 
+            are shuffled together. Elsewhere sequences are N. 
+            Shuffles are cached on disk.
+            """
+        length = max(1,length)
+        if shuffle not in self.shuffles or self.shuffles[shuffle][0] < length:
+            intervals = merge_intervals(
+                [ fetcher.shifted(0,length) for name, piler in self.pilers for fetcher, bins in piler.fetchers ],
+                SHUFFLE_FLANK)
+            names = sorted(intervals)
+            
+            texts = [ ]
+            digest = hashlib.md5()
+            for name in names:
+                seq = self.ref.seqs[name]
+                intervals[name] = [ (max(0,start), min(len(seq),end)) for start, end in intervals[name] ]
+                for start, end in intervals[name]:
+                    texts.append(seq[start:end].upper())
+                    # Key on the content of the intervals, so any change in reference or regions is noticed
+                    digest.update("%s:%d:%s\n" % (name, start, texts[-1]))
+            
+            texts = env.cached(
+                [ join(self.ref.dirname,"reference.fa") ],
+                "shuffle-k%d-sd%g-flank%d" % (shuffle, SHUFFLE_SD, SHUFFLE_FLANK),
+                lambda: shuffle_texts(texts, shuffle, SHUFFLE_SD),
+                extra=digest.hexdigest())
+            
+            seqs = { }
+            i = 0
+            for name in names:
+                starts = [ start for start, end in intervals[name] ]
+                seqs[name] = Shuffled_sequence(len(self.ref.seqs[name]), starts, texts[i:i+len(starts)])
+                i += len(starts)
+            self.shuffles[shuffle] = (length, seqs)
+        
+        return self.shuffles[shuffle][1]
+    
+    def fetch_regions(self, length):
+        """ Fetch (and shuffle) sequences for all pilers and frames, extended enough for motifs up to length.
+            These are then shared by all motifs. """
+        for name, piler in self.pilers:
+            for suffix, width, style, shuffle in self.lines(length):
+                self.regions(piler, length, shuffle)
+        self.frame_regions
+    
+    def fetch_kmer_piles(self, recognizers):
+        """ Pile all k-mers of each length used by plain k-mer recognizers,
+            so that worker processes share these piles rather than each making their own. """
+        kmers = [ item.kmer for item in recognizers if getattr(item, "kmer", None) is not None ]
+        for k in sorted(set( len(kmer) for kmer in kmers )):
+            for name, piler in self.pilers:
+                for suffix, width, style, shuffle in self.lines(k):
+                    for i in xrange(len(self.set_weights)):
+                        self.kmer_pile(piler, shuffle, i, "A"*k)
+    
     @env.memo_property
-    def shuffle_1(self):
-        return shuffle_all(self.ref.seqs, 1, 10.0)
-
-    @env.memo_property
-    def shuffle_2(self):
-        return shuffle_all(self.ref.seqs, 2, 10.0)
+    def frame_regions(self):
+        return dict(
+            (name, pilers.Regions(self.ref.seqs, features, 0))
+            for name, frame_title, features in self.frames )
 
 
 def frame_report(
-        prefix, title, features, recognizer, context
+        prefix, title, features, recognizer, context, regions=None
         ):
+    if regions is None:
+        regions = pilers.Regions(context.ref.seqs, features, 0)
+    
     # Construct data frame
     import pandas
     frame = pandas.DataFrame()
@@ -203,10 +360,7 @@ def frame_report(
     frame["gene"] = [ context.ref.genes[item].attr.get("gene","") for item in context.genes ]
     frame["in_set"] = numpy.where(context.set_weights[0][1] > 0.0, 1, 0)
     frame["length"] = [ item.get_length() for item in features ]
-    frame["count"] = [
-        recognizer.count( item.get_seq(context.ref.seqs).upper() )
-        for item in features
-        ]
+    frame["count"] = regions.count(recognizer)
     frame.to_csv(prefix+".csv")
     
     # Do stuff in R    
@@ -263,11 +417,16 @@ def recognizer_report(
         pylab.subplot(gs[0])
         piler.setup_figure()
         
-        lines = [("",3.0,"-",context.ref.seqs)]
-        if recognizer.length > 2:
-            lines.append((", shuffle sd=10 k=2",1.0,"--",context.shuffle_2))
-        if recognizer.length > 1:
-            lines.append((", shuffle sd=10 k=1",1.0,":",context.shuffle_1))
+        lines = context.lines(recognizer.length)
+        
+        # Scan once, then bin for each gene set.
+        # Plain k-mers instead use piles of all k-mers of the same length, shared between recognizers.
+        kmer = getattr(recognizer, "kmer", None)
+        scans = [ ]
+        if kmer is None:
+            for suffix,width,style,shuffle in lines:
+                regions = context.regions(piler, recognizer.length, shuffle)
+                scans.append((regions, recognizer.scan(regions.text, regions.codes)))
     
         for i, (set_name, set_weights) in enumerate(context.set_weights):
             a = float(i)/len(context.set_weights) * numpy.pi * 2.0
@@ -276,10 +435,14 @@ def recognizer_report(
                 numpy.cos(a+numpy.pi*2/3)*0.5+0.5,
                 numpy.cos(a+numpy.pi*4/3)*0.5+0.5
                 )
-            for suffix,width,style,seqs in lines:
+            for j, (suffix,width,style,shuffle) in enumerate(lines):
+                if kmer is None:
+                    pile = piler.bin(scans[j][0], scans[j][1], set_weights)
+                else:
+                    pile = context.kmer_pile(piler, shuffle, i, kmer)
                 pylab.plot(
                     piler.x,
-                    piler.pile(seqs, recognizer, set_weights),
+                    pile,
                     label=set_name + suffix,
                     color=color,
                     linewidth=width,
@@ -316,7 +479,8 @@ def recognizer_report(
             best_p = 1.0        
             for name, frame_title, features in context.frames:
                 prefix = join(out_dir,name)
-                p = frame_report(prefix, title+": "+frame_title, features, recognizer, context)
+                p = frame_report(prefix, title+": "+frame_title, features, recognizer, context,
+                    context.frame_regions[name])
                 write(f_index, 
                     '<br/><a href="%s.html">' % name + 
                     frame_title + "</a> " + p_html(p) + "\n"
@@ -365,6 +529,20 @@ def make_summary(out_dir, context):
 
         
 
+# Set before the pool is forked, so workers share it rather than having it pickled to them
+_REPORT_STATE = None
+
+def _recognizer_report_task(n):
+    out_dir, context, items = _REPORT_STATE
+    name, recognizer = items[n-1]
+    return recognizer_report(
+        join(out_dir,"motifs",str(n)),
+        recognizer,
+        context,
+        title=name
+        )
+
+
 def report(
         out_dir,
         ref_dir,
@@ -373,6 +551,7 @@ def report(
         gene_sets,
         
         title="Motif plots",
+        processes=None,
         ):
     """
     
@@ -393,61 +572,80 @@ def report(
     gene_sets - [ (name, [ locus_tag, ... ]), ... ]
         One or more gene sets.
     
+    processes - int
+        Number of worker processes to produce motif reports with.
+        Workers are forked, and share the sequences and piles already loaded. 
+        Use 1 to work in this process, eg when called from a nesoni make 
+        that has only given us one core. Defaults to $NESONI_CORES or the 
+        number of cores.
+    
     """
+    global _REPORT_STATE
+    
     context = Context(ref_dir, utr_filename, gene_sets)
+    items = [ item for item in recognizers if not isinstance(item, str) ]
+    context.fetch_regions(max([ 1 ] + [ item[1].length for item in items ]))
+    context.fetch_kmer_piles([ item[1] for item in items ])
     
     require_dir(out_dir)
     require_dir(join(out_dir,"motifs"))
     
-    make_summary(join(out_dir,"summary"), context)
+    if processes is None:
+        processes = int(os.environ.get('NESONI_CORES','0')) or multiprocessing.cpu_count()
     
-    n = 0
-    sidebar = [ ]
-    for item in recognizers:
-        if isinstance(item, str):
-            sidebar.append("<h2>%s</h2>\n"%item)
+    # Note: R (used by make_summary and frame_report) must not be started before the pool is forked
+    _REPORT_STATE = (out_dir, context, items)
+    pool = None
+    try:
+        if processes == 1:
+            results = (_recognizer_report_task(n) for n in xrange(1,len(items)+1))
         else:
-            name, recognizer = item
-            print name
-            n += 1
-            item_dir = join(out_dir,"motifs",str(n))
-            p = recognizer_report(
-                item_dir,
-                recognizer,
-                context,
-                title=name
-                )
-            sidebar.append('<a target="box" href="motifs/%d/index.html">%s</a> %s<br/>\n' % (n, name, p_html(p)))
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap(_recognizer_report_task, xrange(1,len(items)+1))
+        
+        n = 0
+        sidebar = [ ]
+        for item in recognizers:
+            if isinstance(item, str):
+                sidebar.append("<h2>%s</h2>\n"%item)
+            else:
+                name, recognizer = item
+                p = results.next()
+                print name
+                n += 1
+                sidebar.append('<a target="box" href="motifs/%d/index.html">%s</a> %s<br/>\n' % (n, name, p_html(p)))
         
-        with open(join(out_dir,"index.html"),"wb") as f:
-            html_header(f, title, False)
-            write(f,textwrap.dedent("""
-                <style>
-                body { padding: 0; margin: 0; overflow: hidden; }
-                </style>
-                <table cellpadding="0" cellspacing="0" style="margin:0;padding0">
-                    <tr>
-                        <td>
-                            <div style="width: 20vw; height: 100vh; overflow-y: scroll">
-                                <div style="padding: 0.5em">
-                                    <p><a href="summary/index.html">Summary of gene sets</a>
-                                    %s
+            with open(join(out_dir,"index.html"),"wb") as f:
+                html_header(f, title, False)
+                write(f,textwrap.dedent("""
+                    <style>
+                    body { padding: 0; margin: 0; overflow: hidden; }
+                    </style>
+                    <table cellpadding="0" cellspacing="0" style="margin:0;padding0">
+                        <tr>
+                            <td>
+                                <div style="width: 20vw; height: 100vh; overflow-y: scroll">
+                                    <div style="padding: 0.5em">
+                                        <p><a href="summary/index.html">Summary of gene sets</a>
+                                        %s
+                                    </div>
                                 </div>
-                            </div>
-                        </td>
-                        <td>
-                            <iframe name="box" style="border: 0; width: 80vw; height: 100vh;"/>
-                        </td>
-                    </tr>
-                </table>
-                """) % "".join(sidebar))
-            
-            
-            
-
-
-
-
-
-
+                            </td>
+                            <td>
+                                <iframe name="box" style="border: 0; width: 80vw; height: 100vh;"/>
+                            </td>
+                        </tr>
+                    </table>
+                    """) % "".join(sidebar))
+        
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool = None
+        
+        make_summary(join(out_dir,"summary"), context)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _REPORT_STATE = None
 
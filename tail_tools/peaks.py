@@ -1,8 +1,13 @@
 
-import collections, os
+import collections, os, bisect
+import cPickle as pickle
+
+import numpy
 
 import nesoni
-from nesoni import config, sam, workspace, legion, grace, annotation, span_index
+from nesoni import config, sam, workspace, legion, grace, annotation, span_index, io
+
+from . import bigwig
 
 
 @config.help(
@@ -36,12 +41,19 @@ from nesoni import config, sam, workspace, legion, grace, annotation, span_index
     'polya', 
     'Only use poly(A) reads.'
     )
+@config.Float_flag(
+    'preview',
+    'Quick preview: call peaks from only this fraction of reads, '
+    'chosen by samtools using a seeded hash of the read name. '
+    'Depths are scaled up accordingly. 0 to use all reads.'
+    )
 @config.Main_section(
     'filenames',
     'Working directories or BAM files (sorted by read name).'
     )
 class Find_peaks(config.Action_with_prefix):
     lap = 0
+    preview = 0.0
     type = 'peak'
     polya = True
     filenames = [ ]
@@ -50,82 +62,179 @@ class Find_peaks(config.Action_with_prefix):
     radius = 20
     
     def run(self):
-        spans = { }
+        pileups = { }
+        for item in legion.parallel_imap(self._load_packed_pileup, self.filenames):
+            for key, (positions, counts, AN, AG) in item.iteritems():
+                pileups.setdefault(key, [ ]).append((
+                    numpy.frombuffer(positions, 'int64'), numpy.frombuffer(counts, 'float64'),
+                    numpy.frombuffer(AN, 'float64'), numpy.frombuffer(AG, 'float64') ))
         
-        #for item in legion.parallel_imap(self._load_bam, self.filenames):
-        #    for key,value in item.items():
-        for filename in self.filenames:
-            self._load_bam(filename, spans)
+        # Sum over samples
+        spans = { }
+        for key, items in pileups.iteritems():
+            positions, index = numpy.unique(
+                numpy.concatenate([ item[0] for item in items ]), return_inverse=True)
+            spans[key] = (positions,) + tuple(
+                numpy.bincount(index, numpy.concatenate([ item[i] for item in items ]), len(positions))
+                for i in (1,2,3) )
+        del pileups
 
         grace.status('Calling peaks')
 
-        f = open(self.prefix+'.gff', 'wb')
-        annotation.write_gff3_header(f)
+        # Deterministic output order: contigs in BAM header order, then strand
+        rnames = [ ]
+        if self.filenames:
+            header = sam.parsed_bam_headers(_bam_filename(self.filenames[0]))
+            rnames = [ entry["SN"] for entry in header["SQ"] ]
+        rname_order = dict( (rname,i) for i,rname in enumerate(rnames) )
+        keys = sorted(spans, 
+            key=lambda (rname, strand): (rname_order.get(rname, len(rnames)), rname, strand))
+
+        # Workers read the pileup for their contig and strand from a file,
+        # rather than having it pickled to them through the coordinator
+        with workspace.tempspace() as temp:
+            filenames = [ ]
+            for i, key in enumerate(keys):
+                filenames.append(temp/('%d.npz' % i))
+                positions, counts, AN, AG = spans.pop(key)
+                numpy.savez(filenames[-1], positions=positions, counts=counts, AN=AN, AG=AG)
         
-        n = 0
-
-        for (rname, strand), span_counts in spans.items():
-            length = 1+max( item[1] for item in span_counts )
-            depth = [ 0.0 ] * length
-            AN_total = [ 0.0 ] * length
-            AG_total = [ 0.0 ] * length 
-            for (start, end, AN, AG), count in span_counts.iteritems():
-                depth[start] += 1.0*count
-                depth[end] -= 1.0*count
-                AN_total[start] += AN*count
-                AN_total[end] -= AN*count
-                AG_total[start] += AG*count
-                AG_total[end] -= AG*count
-            
-            for i in xrange(1,length):
-                depth[i] += depth[i-1]
-                AN_total[i] += AN_total[i-1]
-                AG_total[i] += AG_total[i-1]
+            f = open(self.prefix+'.gff', 'wb')
+            annotation.write_gff3_header(f)
+        
+            n = 0
 
-            for start, end in self._find_spans(depth):
-                if end-self.lap-start <= 0: continue
-                
-                n += 1
+            for (rname, strand), peaks in zip(keys, legion.parallel_imap(self._call_peaks, filenames)):
+                for start, end, depth, AN_total, AG_total in peaks:
+                    n += 1
                 
-                id = 'peak%d' % n
+                    id = 'peak%d' % n
                 
-                ann = annotation.Annotation()
-                ann.source = 'tailtools'
-                ann.type = self.type
-                ann.seqid = rname
-                ann.start = start
-                ann.end = end - self.lap
+                    ann = annotation.Annotation()
+                    ann.source = 'tailtools'
+                    ann.type = self.type
+                    ann.seqid = rname
+                    ann.start = start
+                    ann.end = end - self.lap
                 
-                if ann.end != ann.start+1:
-                    self.log.log("%s odd: start %d end %d\n" % (id, ann.start, ann.end))
-
-                ann.strand = strand
-                ann.score = None
-                ann.phase = None
-                ann.attr = { 
-                    'id' : id,
-                    'n' : str(depth[start+self.lap//2]),
-                    'mean_tail' : str(AN_total[start+self.lap//2]/depth[start+self.lap//2]),
-                    'mean_genomic' : str(AG_total[start+self.lap//2]/depth[start+self.lap//2]),
-                    'color' : '#00ff00' if strand > 0 else '#0000ff' if strand < 0 else '#008080',
-                    }
-                print >> f, ann.as_gff()
-            f.flush()
-
-        f.close()
+                    if ann.end != ann.start+1:
+                        self.log.log("%s odd: start %d end %d\n" % (id, ann.start, ann.end))
+
+                    ann.strand = strand
+                    ann.score = None
+                    ann.phase = None
+                    ann.attr = { 
+                        'id' : id,
+                        'n' : str(depth),
+                        'mean_tail' : str(AN_total/depth),
+                        'mean_genomic' : str(AG_total/depth),
+                        'color' : '#00ff00' if strand > 0 else '#0000ff' if strand < 0 else '#008080',
+                        }
+                    print >> f, ann.as_gff()
+                f.flush()
+
+            f.close()
         
         self.log.datum('-','called peaks',n)
         
         grace.status('')
 
 
-    def _load_bam(self, filename, spans):
-        #spans = { }
+    def _call_peaks(self, filename):
+        """ Call peaks on one contig and strand, from a pileup saved by run(). 
+            Returns [ (start, end, depth, AN total, AG total) ] 
+            with end still including lap. """
+        if 1+self.lap <= 0: return [ ]
+        
+        data = numpy.load(filename)
+        ends = (data['positions'], data['counts'], data['AN'], data['AG'])
+        positions, depth, AN_total, AG_total = self._profile(ends)
+        
+        result = [ ]
+        for start, end in self._find_spans(positions, depth):
+            if end-self.lap-start <= 0: continue
+            k = bisect.bisect_right(positions, start+self.lap//2)-1
+            result.append((start, end, depth[k], AN_total[k], AG_total[k]))
+        return result
+
 
+    def _load_pileup(self, filename):
+        """ 3' end pileup of a sample, from the sample's pileup file if it is 
+            newer than the BAM file, otherwise from the BAM file 
+            (in which case the pileup file is (re)written). 
+            
+            Pileups do not depend on --lap, --radius or --min-depth, 
+            so peaks can be re-called with different settings 
+            without reading the BAM files again.
+            """
+        bam_filename = _bam_filename(filename)
+        
+        if self.preview:
+            # Random subsample of reads, scaled up, and not cached
+            with workspace.tempspace() as temp:
+                preview_filename = bigwig.preview_bam(bam_filename, temp/'preview.bam', self.preview)
+                result = self._pileup_arrays(self._load_bam(preview_filename))
+            for ends in result.values():
+                for item in ends[1:]:
+                    item /= self.preview
+            return result
+        
         if os.path.isdir(filename):
-            filename = os.path.join(filename, "alignments_filtered_sorted.bam")
+            pileup_filename = os.path.join(filename, 'three_prime_ends')
+        else:
+            pileup_filename = bam_filename + '.three_prime_ends'
+        if self.polya:
+            pileup_filename += '_polya'
+        
+        if (os.path.exists(pileup_filename+'.pickle.gz') and 
+                os.path.getmtime(pileup_filename+'.pickle.gz') >= os.path.getmtime(bam_filename)):
+            f = io.open_possibly_compressed_file(pileup_filename+'.pickle.gz')
+            result = pickle.load(f)
+            f.close()
+            return result
+        
+        result = self._pileup_arrays(self._load_bam(filename))
         
-        for alignment in sam.Bam_reader(filename):
+        # Write to a temporary file then rename, so concurrent readers never see a partial file
+        temp_filename = pileup_filename + '.%d.tmp' % os.getpid()
+        try:
+            f = io.open_possibly_compressed_writer(temp_filename+'.pickle.gz')
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(temp_filename+'.pickle.gz', pileup_filename+'.pickle.gz')
+        except (IOError, OSError):
+            # Sample directory may be read-only
+            pass
+        
+        return result
+
+
+    def _pileup_arrays(self, ends):
+        """ Convert _load_bam() output to arrays sorted by position. """
+        result = { }
+        for key, key_ends in ends.iteritems():
+            positions = sorted(key_ends)
+            result[key] = (
+                numpy.array(positions, 'int64'),
+                numpy.array([ key_ends[pos][0] for pos in positions ], 'float64'),
+                numpy.array([ key_ends[pos][1] for pos in positions ], 'float64'),
+                numpy.array([ key_ends[pos][2] for pos in positions ], 'float64'),
+                )
+        return result
+
+
+    def _load_packed_pileup(self, filename):
+        # legion.parallel_imap returns results from workers using marshal, so send arrays as strings
+        return dict( 
+            (key, [ item.tobytes() for item in ends ]) 
+            for key, ends in self._load_pileup(filename).iteritems() )
+
+
+    def _load_bam(self, filename):
+        """ Returns { (rname, strand) : { 3' end position : [count, AN sum, AG sum] } } """
+        spans = { }
+
+        for alignment in sam.Bam_reader(_bam_filename(filename)):
             if alignment.is_unmapped or alignment.is_secondary or alignment.is_supplementary:
                 continue
         
@@ -140,55 +249,118 @@ class Find_peaks(config.Action_with_prefix):
         
             strand = -1 if alignment.flag&sam.FLAG_REVERSE else 1
         
-            start = alignment.reference_start
-            end = alignment.reference_end
-
             # 3' end            
             if strand >= 0:
-                start = end-1
+                pos = alignment.reference_end-1
             else:
-                end = start+1
-            
-            if end+self.lap-start <= 0: continue
+                pos = alignment.reference_start
             
             spans_key = (alignment.reference_name, strand)
             if spans_key not in spans: 
                 spans[spans_key] = { }
-            key = (start,end+self.lap, AN,AG)
-            if key not in spans[spans_key]:
-                spans[spans_key][key] = 1
-            else:
-                spans[spans_key][key] += 1
-            #spans[(rname, strand)].append((start,end+self.lap, AN,AG))
+            if pos not in spans[spans_key]:
+                spans[spans_key][pos] = [ 0, 0.0, 0.0 ]
+            item = spans[spans_key][pos]
+            item[0] += 1
+            item[1] += AN
+            item[2] += AG
                 
-        #return spans
+        return spans
+
+
+    def _profile(self, ends):
+        """ Depth and total AN and AG as step functions, 
+            from a pileup of 3' ends (positions, counts, AN sums, AG sums).
+            
+            Value [k] applies from positions[k] up to positions[k+1] 
+            (the final value, zero, applies to the single base positions[-1]).
+            Only breakpoints are stored, so memory used depends on 
+            the number of distinct 3' end positions rather than contig length.
+            """
+        ends_positions, counts, AN, AG = ends
+        positions, index = numpy.unique(
+            numpy.concatenate([ ends_positions, ends_positions+(1+self.lap) ]), return_inverse=True)
+        
+        totals = [ ]
+        for weights in (counts, AN, AG):
+            deltas = numpy.bincount(index, numpy.concatenate([ weights, -weights ]), len(positions))
+            totals.append(numpy.cumsum(deltas))
+        
+        if positions[0] > 0:
+            positions = numpy.concatenate([ [0], positions ])
+            totals = [ numpy.concatenate([ [0.0], item ]) for item in totals ]
+        
+        # Python values, so output formatting is unchanged
+        return [ positions.tolist() ] + [ item.tolist() for item in totals ]
+
+
+    def _find_spans(self, positions, depth):
+        # Runs of equal depth, as (start, end, depth)
+        runs = [ ]
+        for k in xrange(len(positions)):
+            end = positions[k+1] if k+1 < len(positions) else positions[k]+1
+            if runs and runs[-1][2] == depth[k]:
+                runs[-1] = (runs[-1][0], end, depth[k])
+            else:
+                runs.append((positions[k], end, depth[k]))
+        
+        return self._find_spans_in_runs(runs)
 
 
-    def _find_spans(self, depth):
+    def _find_spans_in_runs(self, runs):
+        """ A run of equal depth is a mode if it is at least min_depth, 
+            higher than everything within radius before it and 
+            at least as high as everything within radius after it 
+            (ties are resolved in favour of the earliest).
+            
+            Maxima of the windows before and after each run are maintained 
+            in monotonic deques (run indices, decreasing depth),
+            so time taken does not depend on radius.
+            """
         result = [ ]
         
-        i = 0
-        while i < len(depth):
-            j = i+1
-            while j < len(depth) and depth[j] == depth[i]:
-                j += 1
+        before = collections.deque()
+        after = collections.deque()
+        next_after = 0
+        
+        for r in xrange(len(runs)):
+            i, j, value = runs[r]
+            
+            if r:
+                while before and runs[before[-1]][2] <= runs[r-1][2]:
+                    before.pop()
+                before.append(r-1)
+            while before and runs[before[0]][1] <= i-self.radius:
+                before.popleft()
+            
+            while after and after[0] <= r:
+                after.popleft()
+            next_after = max(next_after, r+1)
+            while next_after < len(runs) and runs[next_after][0] < j+self.radius:
+                while after and runs[after[-1]][2] <= runs[next_after][2]:
+                    after.pop()
+                after.append(next_after)
+                next_after += 1
             
             lap = max(0,self.lap-(j-i)+1)
             lap_back = lap//2
             lap_forward = lap-lap_back
 
-            if depth[i] >= self.min_depth:
-                for k in xrange(max(0,i-self.radius),min(len(depth),j+self.radius)):
-                    if depth[k] > depth[i] or (depth[k] == depth[i] and k < i): #Resolve ties arbitrarily
-                        break
-                else:
-                    result.append((i-lap_back,j+lap_forward))                
-            i = j
+            if (value >= self.min_depth and 
+                    not (before and runs[before[0]][2] >= value) and
+                    not (after and runs[after[0]][2] > value)):
+                result.append((i-lap_back,j+lap_forward))                
             
         return result
 
 
 
+def _bam_filename(filename):
+    if os.path.isdir(filename):
+        filename = os.path.join(filename, "alignments_filtered_sorted.bam")
+    return filename
+
+
 def join_descriptions(seq, joiner='/'):
     result = [ ]
     for item in seq:
@@ -309,6 +481,7 @@ class Filter_and_relate_peaks_to_genes(config.Action_with_prefix):
 @config.Int_flag('extension', 'How far downstrand of the gene can the peak be.')
 @config.Bool_flag('polya', 'Only use poly(A) reads.')
 @config.Float_flag('min_tail', 'Minimum average tail length to retain peak.')
+@config.Float_flag('preview', 'Quick preview: call peaks from only this fraction of reads. 0 to use all reads.')
 @config.Main_section('samples', 'List of sample directories as produced by "analyse-polya:" or "analyse-polya-batch:".')
 class Call_peaks(config.Action_with_output_dir):
     lap = 10
@@ -317,6 +490,7 @@ class Call_peaks(config.Action_with_output_dir):
     peak_length = 100
     polya = True
     min_tail = 15.0
+    preview = 0.0
     
     annotations = None
     extension = None
@@ -337,6 +511,7 @@ class Call_peaks(config.Action_with_output_dir):
             radius = self.radius,
             min_depth = self.min_depth,
             polya = self.polya,
+            preview = self.preview,
             ).make()
         
         nesoni.Modify_features(
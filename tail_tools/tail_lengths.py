@@ -1,9 +1,11 @@
 
 import itertools, collections, math, os.path
 
+import numpy
+
 import nesoni
 from nesoni import annotation, sam, span_index, config, grace, working_directory, workspace, io, runr, reporting, selection, legion
-from . import web
+from . import web, columnar
 
 import cPickle as pickle
 
@@ -343,6 +345,35 @@ class Aggregate_tail_counts(config.Action_with_output_dir):
         have_relation = any("Relation" in item.attr for item in annotations)
         have_antisense = any("Antisense_parent" in item.attr for item in annotations)
 
+        def annotation_row(i):
+            row = collections.OrderedDict()
+            row['Length'] = str(annotations[i].end - annotations[i].start)
+            row['gene'] = annotations[i].attr.get('Name','')
+            row['product'] = annotations[i].attr.get('Product','')
+            if have_biotype:
+                row['biotype'] = annotations[i].attr.get('Biotype','')
+            if have_parent:
+                row['parent'] = annotations[i].attr.get('Parent','')
+            if have_relation:
+                row['relation'] = annotations[i].attr.get('Relation','')
+            
+            if have_antisense:
+                row['antisense_gene'] = annotations[i].attr.get('Antisense_name','')
+                row['antisense_product'] = annotations[i].attr.get('Antisense_product','')
+                row['antisense_biotype'] = annotations[i].attr.get('Antisense_biotype','')
+                row['antisense_parent'] = annotations[i].attr.get('Antisense_parent','')
+            
+            row['chromosome'] = str(annotations[i].seqid)
+            row['strand'] = str(annotations[i].strand)
+            row['start'] = str(annotations[i].start+1)
+            row['end'] = str(annotations[i].end)
+            
+            row['reads'] = str(overall_n[i])
+            row['reads-with-tail'] = str(overall_n_tail[i])
+            row['mean-tail'] = str_na(overall_tail[i])
+            row['proportion-with-tail'] = str_na(overall_prop[i])
+            return row
+
         def counts_iter():
             for i in xrange(n_features):
                 row = collections.OrderedDict()
@@ -350,31 +381,9 @@ class Aggregate_tail_counts(config.Action_with_output_dir):
                 for j in xrange(n_samples):
                     row[('Count',names[j])] = '%d' % sample_n[i][j]
 
-                row[('Annotation','Length')] = annotations[i].end - annotations[i].start
-                row[('Annotation','gene')] = annotations[i].attr.get('Name','')
-                row[('Annotation','product')] = annotations[i].attr.get('Product','')
-                if have_biotype:
-                    row[('Annotation','biotype')] = annotations[i].attr.get('Biotype','')
-                if have_parent:
-                    row[('Annotation','parent')] = annotations[i].attr.get('Parent','')
-                if have_relation:
-                    row[('Annotation','relation')] = annotations[i].attr.get('Relation','')
-                
-                if have_antisense:
-                    row[('Annotation','antisense_gene')] = annotations[i].attr.get('Antisense_name','')
-                    row[('Annotation','antisense_product')] = annotations[i].attr.get('Antisense_product','')
-                    row[('Annotation','antisense_biotype')] = annotations[i].attr.get('Antisense_biotype','')
-                    row[('Annotation','antisense_parent')] = annotations[i].attr.get('Antisense_parent','')
-                
-                row[('Annotation','chromosome')] = str(annotations[i].seqid)
-                row[('Annotation','strand')] = str(annotations[i].strand)
-                row[('Annotation','start')] = str(annotations[i].start+1)
-                row[('Annotation','end')] = str(annotations[i].end)
-                
-                row[('Annotation','reads')] = str(overall_n[i])
-                row[('Annotation','reads-with-tail')] = str(overall_n_tail[i])
-                row[('Annotation','mean-tail')] = str_na(overall_tail[i])
-                row[('Annotation','proportion-with-tail')] = str_na(overall_prop[i])
+                for key, value in annotation_row(i).iteritems():
+                    row[('Annotation',key)] = value
+
                 for j in xrange(n_samples):
                     row[('Tail_count',names[j])] = '%d' % sample_n_tail[i][j]
                 for j in xrange(n_samples):
@@ -391,6 +400,24 @@ class Aggregate_tail_counts(config.Action_with_output_dir):
                 yield row
         io.write_csv(work/'counts.csv', counts_iter(), comments=comments)
         
+        # Typed binary copy of counts.csv, for faster loading downstream
+        columnar.write_companion(
+            work/'counts.csv',
+            [ item.get_id() for item in annotations ],
+            [ ('Count', names, 'int32', sample_n),
+              ('Annotation', annotation_row(0).keys() if n_features else [ ], 'string',
+                  ( annotation_row(i).values() for i in xrange(n_features) )),
+              ('Tail_count', names, 'int32', sample_n_tail),
+              ('Tail', names, 'float64', sample_tail),
+              ('Tail_sd', names, 'float64', sample_sd_tail),
+              ] + [
+              ('Tail_quantile_%d'%quantile, names, 'int32', sample_quantile_tail[quantile])
+              for quantile in sample_quantile_tail
+              ] + [
+              ('Proportion', names, 'float64', sample_prop),
+              ],
+            comments)
+        
         
         def write_csv_matrix(filename, matrix):
             def emitter():
@@ -743,22 +770,15 @@ class Collapse_counts(config.Action_with_prefix):
     groups = [ ]
     
     def run(self):
-        data = io.read_grouped_table(
-            self.counts,
-            [('Count',str), ('Annotation',str), ('Tail_count',str), ('Tail',str), ('Proportion',str)],
-            'Count',
-            )
+        data = columnar.read(self.counts)
         
-        features = data['Count'].keys()
-        samples = data['Count'].value_type().keys()
+        features = data.features
+        samples = data['Count'].columns
         
         tags = { }
         for sample in samples:
             tags[sample] = [sample]        
-        for line in data.comments:
-            if line.startswith('#sampleTags='):
-                parts = line[len('#sampleTags='):].split(',')
-                tags[parts[0]] = parts
+        tags.update(data.sample_tags())
         
         group_names = [ ]
         groups = [ ]
@@ -783,51 +803,61 @@ class Collapse_counts(config.Action_with_prefix):
             groups.append(group)
             group_tags.append(this_group_tags)
         
-        result = io.Grouped_table()
-        result.comments = [ '#Counts' ]
+        comments = [ '#Counts' ]
         for item in group_tags:
-            result.comments.append('#sampleTags='+','.join(item))
+            comments.append('#sampleTags='+','.join(item))
         
+        # samples x groups
+        membership = numpy.zeros((len(samples),len(groups)))
+        for j, group in enumerate(groups):
+            for sample in group:
+                membership[samples.index(sample), j] = 1.0
         
-        count = [ ]
-        tail_count = [ ]
-        tail = [ ]
-        proportion = [ ]
-        for feature in features:
-            this_count = [ ]
-            this_tail_count = [ ]
-            this_tail = [ ]
-            this_proportion = [ ]
-            for group in groups:
-                this_this_count = [ ]
-                this_this_tail_count = [ ]
-                this_this_tail = [ ]
-                this_this_proportion = [ ]
-                for sample in group:
-                    this_this_count.append(int(data['Count'][feature][sample]))
-                    this_this_tail_count.append(int(data['Tail_count'][feature][sample]))
-                    item = data['Tail'][feature][sample]
-                    if item != 'NA': this_this_tail.append(float(item))
-                    item = data['Proportion'][feature][sample]
-                    if item != 'NA': this_this_proportion.append(float(item))
-                
-                this_count.append(str(sum(this_this_count)))
-                this_tail_count.append(str(sum(this_this_tail_count)))
-                this_tail.append(str(sum(this_this_tail)/len(this_this_tail)) if this_this_tail else 'NA')
-                this_proportion.append(str(sum(this_this_proportion)/len(this_this_proportion)) if this_this_proportion else 'NA')
-                    
-            count.append(this_count)
-            tail_count.append(this_tail_count)
-            tail.append(this_tail)
-            proportion.append(this_proportion)
+        def total(group):
+            return numpy.rint(numpy.dot(group.values, membership)).astype('int64')
+        
+        def mean_of_present(group):
+            # The group may have been typed int32, with NA_INTEGER for missing values
+            present = ~group.is_na()
+            totals = numpy.dot(numpy.where(present, group.values.astype('float64'), 0.0), membership)
+            n_present = numpy.dot(present.astype('float64'), membership)
+            result = numpy.empty(totals.shape)
+            result.fill(numpy.nan)
+            numpy.divide(totals, n_present, out=result, where=n_present > 0)
+            return result
         
+        count = total(data['Count'])
+        tail_count = total(data['Tail_count'])
+        tail = mean_of_present(data['Tail'])
+        proportion = mean_of_present(data['Proportion'])
+        
+        def text(matrix):
+            return [ 
+                [ 'NA' if item != item else str(item) for item in row ] 
+                for row in matrix.tolist() 
+                ]
+        
+        result = io.Grouped_table()
+        result.comments = comments
         matrix = io.named_matrix_type(features,group_names)
-        result['Count'] = matrix(count)
-        result['Annotation'] = data['Annotation']
-        result['Tail_count'] = matrix(tail_count)
-        result['Tail'] = matrix(tail)
-        result['Proportion'] = matrix(proportion)
+        result['Count'] = matrix(text(count))
+        result['Annotation'] = data.grouped_table(['Annotation'])['Annotation']
+        result['Tail_count'] = matrix(text(tail_count))
+        result['Tail'] = matrix(text(tail))
+        result['Proportion'] = matrix(text(proportion))
         result.write_csv(self.prefix + '.csv')
+        
+        columnar.write_companion(
+            self.prefix + '.csv',
+            features,
+            [ ('Count', group_names, 'int32', count),
+              ('Annotation', data['Annotation'].columns, 'string', 
+                  ( data['Annotation'].row(i) for i in xrange(len(features)) )),
+              ('Tail_count', group_names, 'int32', tail_count),
+              ('Tail', group_names, 'float64', tail),
+              ('Proportion', group_names, 'float64', proportion),
+              ],
+            comments)
 
 
 
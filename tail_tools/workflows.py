@@ -6,7 +6,7 @@ import nesoni
 from nesoni import config, workspace, working_directory, reference_directory, io, reporting, grace, annotation, selection, span_index
 
 import tail_tools
-from . import clip_runs, extend_sam, proportions, tail_lengths, web, alternative_tails, bigwig, web, peaks
+from . import clip_runs, extend_sam, proportions, tail_lengths, web, alternative_tails, bigwig, web, peaks, columnar
 
 def _do_nothing():
     pass
@@ -579,10 +579,16 @@ class Analyse_polya_batch(config.Action_with_output_dir):
         
         if self.groups and os.path.exists(workspace/('peak-shift','grouped.json')):
             r.get(workspace/('peak-shift','grouped.json'))
+            if os.path.exists(workspace/('peak-shift','grouped-json')):
+                # Split by Compare_peaks --json-chunks, chunks are found relative to the main file
+                r.get(workspace/('peak-shift','grouped-json'), prefix='')
             r.p('<a href="view.html?json=%sgrouped.json">&rarr; Gene viewer, grouped samples</a>' % r.file_prefix)
         
         if os.path.exists(workspace/('peak-shift','individual.json')):
             r.get(workspace/('peak-shift','individual.json'))
+            if os.path.exists(workspace/('peak-shift','individual-json')):
+                # Split by Compare_peaks --json-chunks, chunks are found relative to the main file
+                r.get(workspace/('peak-shift','individual-json'), prefix='')
             r.p('<a href="view.html?json=%sindividual.json">&rarr; Gene viewer, individual samples</a>' % r.file_prefix)
         
         r.heading('Raw data')
@@ -711,7 +717,8 @@ class Analyse_polya_batch(config.Action_with_output_dir):
                 norm_file = norms
                 ).make()
             
-            counts_table = io.read_grouped_table(counts)
+            counts_table = columnar.read(counts).grouped_table(
+                ['Annotation','Count','Tail','Tail_count','Proportion'], text=True)
             io.write_csv_2(raw/(name+'-info.csv'), counts_table['Annotation'])
             io.write_csv_2(raw/(name+'-count.csv'), counts_table['Count'])
             io.write_csv_2(raw/(name+'-tail.csv'), counts_table['Tail'])
@@ -763,14 +770,15 @@ class Analyse_polya_batch(config.Action_with_output_dir):
     def _describe_peaks(self, r):        
         workspace = io.Workspace(self.output_dir, must_exist=False)
         
-        counts = io.read_grouped_table(workspace/("expression","peakwise","counts.csv"))["Count"]
+        table = columnar.read(workspace/("expression","peakwise","counts.csv"))
+        totals = table["Count"].values.sum(axis=1)
         
         peak_counts = collections.defaultdict(int)
         read_counts = collections.defaultdict(int)
         total = 0
         for item in annotation.read_annotations(workspace/("peaks","relation-child.gff")):
             peak_counts[item.attr.get("Relation","None")] += 1
-            read_counts[item.attr.get("Relation","None")] += sum(int(c) for c in counts[item.get_id()].values())            
+            read_counts[item.attr.get("Relation","None")] += int(totals[table.feature_index[item.get_id()]])
             total += 1
         
         total_reads = sum(read_counts.values())